@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# [SublimeLinter flake8-max-line-length:150]
+"""Measure the events per second of read_xdst.py without the LHCb software
+
+The Gaudi and LHCb modules are replaced by mock_gaudi so this can run on any
+machine with numpy and pandas. The clusters of a job are first extracted for
+Original_DB, so the true residuals are also calculated, then each
+configuration reads a distorted scenario and the time spent in each stage is
+reported.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+from collections import OrderedDict
+import json
+from os.path import join
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+import mock_gaudi
+
+# Keyword arguments of read_xdst.read_tracks_and_clusters for each configuration
+CONFIGURATIONS = OrderedDict([
+    ('default', {}),
+    ('per-track IP', {'ip_mode': 'track'}),
+    ('straight line POCA', {'poca_mode': 'line'}),
+    ('parquet', {'output_format': 'parquet'}),
+    ('clusters only', {'tables': ['clusters'], 'fake_ut': False}),
+    ('no true residuals', {'truth_residuals': False}),
+])
+
+# msgpack can't be written since pandas 1.0
+DEFAULT_FORMAT = 'msgpack' if hasattr(pd.DataFrame, 'to_msgpack') else 'parquet'
+
+
+def run_configuration(read_xdst, scenario, n_events, output_format, kwargs):
+    """Extract job 0 of <scenario> and return the profile"""
+    os.makedirs(join('output/scenarios', scenario))
+    kwargs = dict({'output_format': output_format}, **kwargs)
+    read_xdst.read_tracks_and_clusters(scenario, 0, n_events, profile_json=True, **kwargs)
+    with open(read_xdst.profile_filename(scenario, 0)) as f:
+        return json.load(f)
+
+
+def run_benchmarks(configurations, n_events=50, n_tracks=60, seed=0, output_format=DEFAULT_FORMAT):
+    """Return the profile of each configuration"""
+    mock_gaudi.install()
+    import read_xdst
+
+    results = OrderedDict()
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        os.chdir(tmp_dir)
+        mock_gaudi.install('Original_DB', n_events=n_events, n_tracks=n_tracks, seed=seed)
+        results['Original_DB'] = run_configuration(read_xdst, 'Original_DB', n_events, output_format, {})
+        for i, name in enumerate(configurations):
+            scenario = 'Benchmark_{}'.format(i)
+            mock_gaudi.install(scenario, n_events=n_events, n_tracks=n_tracks, seed=seed)
+            results[name] = run_configuration(read_xdst, scenario, n_events, output_format, CONFIGURATIONS[name])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def format_results(results):
+    stages = []
+    for result in results.values():
+        stages.extend(stage for stage in result['stages'] if stage not in stages)
+
+    lines = ['{:<20} {:>10}'.format('Configuration', 'Events/s') + ''.join(' {:>14}'.format(stage) for stage in stages)]
+    for name, result in results.items():
+        line = '{:<20} {:>10.1f}'.format(name, result['events_per_second'])
+        for stage in stages:
+            if stage in result['stages']:
+                line += ' {:>13.1f}%'.format(100 * result['stages'][stage]['time'] / result['elapsed'])
+            else:
+                line += ' {:>14}'.format('')
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the events per second of read_xdst.py with mock events')
+    parser.add_argument(
+        '--n-events', '-n', type=int, default=50,
+        help='The number of events to read for each configuration'
+    )
+    parser.add_argument(
+        '--n-tracks', type=int, default=60,
+        help='The number of prompt tracks in each event'
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='The seed used to generate the events'
+    )
+    parser.add_argument(
+        '--format', choices=['msgpack', 'parquet'], default=DEFAULT_FORMAT,
+        help='The file format to write the output tables in, unless set by the configuration (msgpack if pandas can write it)'
+    )
+    parser.add_argument(
+        '--configurations', nargs='+', choices=list(CONFIGURATIONS), default=list(CONFIGURATIONS),
+        help='The configurations to measure'
+    )
+    parser.add_argument(
+        '--json',
+        help='Also save the profile of each configuration to this file'
+    )
+
+    args = parser.parse_args()
+    results = run_benchmarks(args.configurations, args.n_events, args.n_tracks, args.seed, args.format)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,173 @@
+# [SublimeLinter flake8-max-line-length:150]
+"""Catalog of the tables written by read_xdst.py
+
+Finding the outputs by globbing and probing every possible file is slow on a
+network filesystem with many scenarios, so the number of rows, size, schema
+version and modification time of every table of every job is kept in a JSON
+file. read_xdst.py updates it after writing a job and ``load`` builds it by
+scanning the output directory the first time it is needed.
+"""
+from __future__ import division
+from __future__ import print_function
+
+from contextlib import contextmanager
+import fcntl
+from glob import glob
+from os.path import basename, isdir, isfile, join
+import json
+import os
+import re
+
+import table_io
+from table_schema import SCHEMA_VERSION, TABLE_NAMES
+
+CATALOG_FILENAME = 'output/catalog.json'
+SCENARIOS_DIR = 'output/scenarios'
+
+
+class Catalog(object):
+    """The tables of each job of each scenario
+
+    ``entries[scenario][job_id][table]`` is a dictionary with the filename
+    (relative to the scenario's directory), rows, bytes, schema_version and
+    mtime of the table.
+    """
+    def __init__(self, entries=None, scenarios_dir=SCENARIOS_DIR):
+        self.entries = {} if entries is None else entries
+        self.scenarios_dir = scenarios_dir
+
+    @classmethod
+    def from_file(cls, fn, scenarios_dir=SCENARIOS_DIR):
+        with open(fn) as f:
+            data = json.load(f)
+        entries = {
+            scenario: {int(job_id): tables for job_id, tables in jobs.items()}
+            for scenario, jobs in data['scenarios'].items()
+        }
+        return cls(entries, scenarios_dir)
+
+    def save(self, fn):
+        data = {'scenarios': {
+            scenario: {str(job_id): tables for job_id, tables in jobs.items()}
+            for scenario, jobs in self.entries.items()
+        }}
+        with open(fn + '.tmp', 'w') as f:
+            json.dump(data, f, sort_keys=True)
+        os.rename(fn + '.tmp', fn)
+
+    @classmethod
+    def build(cls, scenarios_dir=SCENARIOS_DIR):
+        """Build the catalog by scanning the output directory
+
+        The schema version of the tables isn't known so it's None.
+        """
+        catalog = cls(scenarios_dir=scenarios_dir)
+        pattern = re.compile(r'^({})_(\d+)\.({})$'.format('|'.join(TABLE_NAMES), '|'.join(table_io.EXTENSIONS.values())))
+        for scenario_dir in sorted(glob(join(scenarios_dir, '*'))):
+            if not isdir(scenario_dir):
+                continue
+            job_ids = set()
+            for fn in os.listdir(scenario_dir):
+                match = pattern.match(fn)
+                if match:
+                    job_ids.add(int(match.group(2)))
+            for job_id in sorted(job_ids):
+                catalog.scan_job(basename(scenario_dir), job_id)
+        return catalog
+
+    def scan_job(self, scenario, job_id, written=()):
+        """Record the tables of a job which exist on disk
+
+        The tables in <written> were just written with the current schema, the
+        schema version of the others is kept if they haven't been modified.
+        """
+        out_dir = join(self.scenarios_dir, scenario)
+        index_fn = table_io.index_filename(out_dir, job_id)
+        index = table_io.EventIndex.load(index_fn) if isfile(index_fn) else None
+
+        tables = {}
+        for table in TABLE_NAMES:
+            fn = table_io.find_table(out_dir, table, job_id)
+            if fn is None:
+                continue
+            if index is not None and table in index.ranges:
+                n_rows = index.ranges[table][-1][1] if index.ranges[table] else 0
+            else:
+                n_rows = count_rows(fn)
+            tables[table] = {
+                'filename': basename(fn),
+                'rows': n_rows,
+                'bytes': os.path.getsize(fn),
+                'schema_version': None,
+                'mtime': os.path.getmtime(fn),
+            }
+            previous = self.entries.get(scenario, {}).get(job_id, {}).get(table)
+            if table in written:
+                tables[table]['schema_version'] = SCHEMA_VERSION
+            elif previous is not None and previous['mtime'] == tables[table]['mtime']:
+                tables[table]['schema_version'] = previous['schema_version']
+
+        if tables:
+            self.entries.setdefault(scenario, {})[job_id] = tables
+        elif job_id in self.entries.get(scenario, {}):
+            del self.entries[scenario][job_id]
+
+    def scenarios(self, table=None):
+        """Return the scenarios which have any tables, or <table> if given"""
+        return sorted(
+            scenario for scenario, jobs in self.entries.items()
+            if any(table is None or table in tables for tables in jobs.values())
+        )
+
+    def job_ids(self, scenario, table):
+        return sorted(job_id for job_id, tables in self.entries.get(scenario, {}).items() if table in tables)
+
+    def entry(self, scenario, table, job_id):
+        return self.entries[scenario][job_id][table]
+
+    def filename(self, scenario, table, job_id):
+        return join(self.scenarios_dir, scenario, self.entry(scenario, table, job_id)['filename'])
+
+    def n_rows(self, scenario, table, job_ids=None):
+        job_ids = self.job_ids(scenario, table) if job_ids is None else job_ids
+        return sum(self.entry(scenario, table, job_id)['rows'] for job_id in job_ids)
+
+
+def count_rows(fn):
+    """Number of rows in a table, only parquet files can be counted without reading them"""
+    if fn.endswith('.parquet'):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetFile(fn).metadata.num_rows
+    return len(table_io.read_table(fn))
+
+
+@contextmanager
+def _locked(fn):
+    """Stop several processes from updating the catalog at once"""
+    with open(fn + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load(fn=CATALOG_FILENAME, scenarios_dir=SCENARIOS_DIR, rebuild=False):
+    """Load the catalog, building it if it doesn't exist yet or <rebuild> is True"""
+    if isfile(fn) and not rebuild:
+        return Catalog.from_file(fn, scenarios_dir)
+    with _locked(fn):
+        catalog = Catalog.build(scenarios_dir)
+        catalog.save(fn)
+    return catalog
+
+
+def update_job(scenario, job_id, tables=TABLE_NAMES, fn=CATALOG_FILENAME, scenarios_dir=SCENARIOS_DIR):
+    """Record the tables of a job after <tables> have been written"""
+    with _locked(fn):
+        if isfile(fn):
+            catalog = Catalog.from_file(fn, scenarios_dir)
+        else:
+            catalog = Catalog.build(scenarios_dir)
+        catalog.scan_job(scenario, job_id, tables)
+        catalog.save(fn)
@@ -0,0 +1,94 @@
+# [SublimeLinter flake8-max-line-length:150]
+"""Read-only, array-backed cluster positions of a single event
+
+The same store is used for the clusters table, the clusters of each VPHit and
+the lookup of the true cluster positions so the positions of an event are only
+ever copied once.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+
+def _readonly(array, dtype):
+    array = np.ascontiguousarray(array, dtype=dtype)
+    array.setflags(write=False)
+    return array
+
+
+class ClusterStore(object):
+    """Channel IDs and positions of the clusters of an event
+
+    The arrays can't be modified and the map of channel ID to row is only
+    built when a cluster is first looked up.
+    """
+    def __init__(self, channel_ids, x, y, z):
+        self._channel_ids = _readonly(channel_ids, np.int64)
+        self._x = _readonly(x, np.float64)
+        self._y = _readonly(y, np.float64)
+        self._z = _readonly(z, np.float64)
+        assert len(self._channel_ids) == len(self._x) == len(self._y) == len(self._z)
+        self._rows = None
+
+    @classmethod
+    def from_clusters(cls, clusters):
+        """Build the store from an ``LHCb::VPCluster`` container"""
+        columns = [(c.channelID().channelID(), c.x(), c.y(), c.z()) for c in clusters]
+        channel_ids, x, y, z = zip(*columns) if columns else ([], [], [], [])
+        return cls(channel_ids, x, y, z)
+
+    @property
+    def channel_ids(self):
+        return self._channel_ids
+
+    @property
+    def x(self):
+        return self._x
+
+    @property
+    def y(self):
+        return self._y
+
+    @property
+    def z(self):
+        return self._z
+
+    def __len__(self):
+        return len(self._channel_ids)
+
+    def __contains__(self, channel_id):
+        return channel_id in self.row_map
+
+    @property
+    def row_map(self):
+        """Dictionary of channel ID to row"""
+        if self._rows is None:
+            self._rows = {channel_id: row for row, channel_id in enumerate(self._channel_ids.tolist())}
+        return self._rows
+
+    def row(self, channel_id):
+        try:
+            return self.row_map[channel_id]
+        except KeyError:
+            raise KeyError('Cluster not found: ' + repr(channel_id))
+
+    def rows(self, channel_ids):
+        row_map = self.row_map
+        missing = [c for c in channel_ids if c not in row_map]
+        if missing:
+            raise KeyError('Clusters not found: ' + repr(missing))
+        return np.array([row_map[c] for c in channel_ids], dtype=np.intp)
+
+    def position(self, channel_id):
+        row = self.row(channel_id)
+        return self._x[row], self._y[row], self._z[row]
+
+    def positions(self, channel_ids):
+        """Return an (n, 3) array with the positions of the clusters with ``channel_ids``"""
+        rows = self.rows(channel_ids)
+        return np.column_stack([self._x[rows], self._y[rows], self._z[rows]])
+
+    def iter_rows(self):
+        """Iterate over ``(channel_id, x, y, z)`` for every cluster"""
+        return zip(self._channel_ids.tolist(), self._x.tolist(), self._y.tolist(), self._z.tolist())
@@ -0,0 +1,673 @@
+# [SublimeLinter flake8-max-line-length:150]
+"""Stand-in for the parts of Gaudi and LHCb used by track_tools and read_xdst
+
+``install()`` puts fake ``GaudiPython``, ``ROOT``, ``LHCbMath``, ``LoKi*``,
+``LinkerInstances``, ``Configurables``, ``GaudiConf`` and ``LHCbConfig``
+modules into ``sys.modules`` so read_xdst.py can be run without the LHCb
+software. The events are synthetic: straight tracks from a few PVs leave one
+cluster per VELO module, most tracks are linked to an MC particle and some
+events contain a D*+ -> D0(K+ K-) pi+ decay. The extrapolator, TrajPoca and
+vertex fitter are replaced by straight line calculations.
+
+The same seed gives the same events for every scenario, apart from the
+cluster positions which are shifted by <distortion> (mm per module) for
+scenarios other than Original_DB, so the true residuals can be tested. Each
+job has different events, the job ID is taken from the path of the input
+files (``hists/<job_id>/Brunel.xdst``) which can be empty.
+"""
+from __future__ import division
+from __future__ import print_function
+
+from math import sqrt
+import re
+import sys
+import types
+
+import numpy as np
+
+# z of the VELO modules
+MODULE_Z = np.linspace(-275., 750., 52)
+
+# Track types and state locations with the same names as in LHCb
+TRACK_TYPES = {1: 'Velo', 3: 'Long', 4: 'Upstream', 5: 'Downstream', 6: 'Ttrack'}
+CLOSEST_TO_BEAM, FIRST_MEASUREMENT = 1, 2
+
+
+class Double(object):
+    """Mutable float which is passed by reference like ``ROOT.Double``"""
+    def __init__(self, value=0.):
+        self.value = value
+
+    def __float__(self):
+        return float(self.value)
+
+
+class XYZVector(object):
+    def __init__(self, x=0., y=0., z=0.):
+        self._xyz = [float(x), float(y), float(z)]
+
+    def x(self):
+        return self._xyz[0]
+
+    def y(self):
+        return self._xyz[1]
+
+    def z(self):
+        return self._xyz[2]
+
+    def SetXYZ(self, x, y, z):
+        self._xyz = [float(x), float(y), float(z)]
+
+    def __sub__(self, other):
+        return XYZVector(*(a - b for a, b in zip(self._xyz, other._xyz)))
+
+    def __add__(self, other):
+        return self.__class__(*(a + b for a, b in zip(self._xyz, other._xyz)))
+
+
+class XYZPoint(XYZVector):
+    pass
+
+
+def _pair(*types_):
+    return lambda first, second: (first, second)
+
+
+class SymMatrix(object):
+    """Symmetric matrix which is read by calling it with (row, column)"""
+    def __init__(self, matrix):
+        self._matrix = matrix
+
+    def __call__(self, i, j):
+        return float(self._matrix[i][j])
+
+
+class State(object):
+    def __init__(self, x, y, z, tx, ty, qop, covariance):
+        self._x, self._y, self._z, self._tx, self._ty, self._qop = x, y, z, tx, ty, qop
+        self._covariance = covariance
+
+    def x(self):
+        return self._x
+
+    def y(self):
+        return self._y
+
+    def z(self):
+        return self._z
+
+    def tx(self):
+        return self._tx
+
+    def ty(self):
+        return self._ty
+
+    def qOverP(self):
+        return self._qop
+
+    def covariance(self):
+        return SymMatrix(self._covariance)
+
+    def position(self):
+        return XYZPoint(self._x, self._y, self._z)
+
+    def slopes(self):
+        return XYZVector(self._tx, self._ty, 1.)
+
+    def clone(self):
+        return State(self._x, self._y, self._z, self._tx, self._ty, self._qop, self._covariance)
+
+    def move(self, z):
+        self._x += self._tx * (z - self._z)
+        self._y += self._ty * (z - self._z)
+        self._z = z
+
+
+class VPChannelID(object):
+    """Channel ID with the same bit layout as ``LHCb::VPChannelID``"""
+    def __init__(self, channel_id):
+        self._channel_id = channel_id
+
+    def channelID(self):
+        return self._channel_id
+
+    def row(self):
+        return self._channel_id & 0xff
+
+    def col(self):
+        return (self._channel_id >> 8) & 0xff
+
+    def chip(self):
+        return (self._channel_id >> 16) & 0x3
+
+    def sensor(self):
+        return (self._channel_id >> 18) & 0x7f
+
+    def module(self):
+        return self.sensor() // 4
+
+    def station(self):
+        return self.module() // 2
+
+    def sidepos(self):
+        return self.module() % 2
+
+    def scol(self):
+        return self.col() // 2
+
+    def __int__(self):
+        return self._channel_id
+
+
+class LHCbID(object):
+    def __init__(self, detector, channel_id):
+        self._detector = detector
+        self._channel_id = channel_id
+
+    def isVP(self):
+        return self._detector == 'VP'
+
+    def isUT(self):
+        return self._detector == 'UT'
+
+    def isFT(self):
+        return self._detector == 'FT'
+
+    def vpID(self):
+        assert self.isVP()
+        return VPChannelID(self._channel_id)
+
+
+class Cluster(object):
+    def __init__(self, channel_id, x, y, z):
+        self._channel_id = VPChannelID(channel_id)
+        self._x, self._y, self._z = x, y, z
+
+    def channelID(self):
+        return self._channel_id
+
+    def x(self):
+        return self._x
+
+    def y(self):
+        return self._y
+
+    def z(self):
+        return self._z
+
+
+class Track(object):
+    def __init__(self, key, track_type, states, lhcb_ids):
+        self._key = key
+        self._type = track_type
+        self._states = states
+        self._lhcb_ids = lhcb_ids
+
+    def key(self):
+        return self._key
+
+    def type(self):
+        return self._type
+
+    def stateAt(self, location):
+        return self._states[location]
+
+    def firstState(self):
+        return min(self._states.values(), key=lambda state: state.z())
+
+    def lhcbIDs(self):
+        return self._lhcb_ids
+
+    def momentum(self):
+        state = self.firstState()
+        p = 1 / abs(state.qOverP())
+        pz = p / sqrt(1 + state.tx()**2 + state.ty()**2)
+        return XYZVector(state.tx() * pz, state.ty() * pz, pz)
+
+    def p(self):
+        return 1 / abs(self.firstState().qOverP())
+
+    def pt(self):
+        momentum = self.momentum()
+        return sqrt(momentum.x()**2 + momentum.y()**2)
+
+
+class Vertex(object):
+    def __init__(self, position=None):
+        self._position = position or XYZPoint()
+        self._chi2 = 0.
+        self._n_dof = 1
+
+    def position(self):
+        return self._position
+
+    def covMatrix(self):
+        return SymMatrix(np.diag([1e-4, 1e-4, 1e-2]))
+
+    def chi2(self):
+        return self._chi2
+
+    def chi2PerDoF(self):
+        return self._chi2 / self._n_dof
+
+
+class ParticleID(object):
+    def __init__(self, pid):
+        self._pid = pid
+
+    def pid(self):
+        return self._pid
+
+
+class MCVertex(object):
+    def __init__(self, position):
+        self._position = position
+
+    def position(self):
+        return self._position
+
+
+class MCParticle(object):
+    def __init__(self, key, pid, momentum, origin, mother=None):
+        self._key = key
+        self._pid = ParticleID(pid)
+        self._momentum = momentum
+        self._origin = MCVertex(origin)
+        self._mother = mother
+
+    def key(self):
+        return self._key
+
+    def particleID(self):
+        return self._pid
+
+    def momentum(self):
+        return self._momentum
+
+    def mother(self):
+        return self._mother
+
+    def originVertex(self):
+        return self._origin
+
+    def endVertices(self):
+        return []
+
+
+class ProtoParticle(object):
+    def __init__(self, track):
+        self._track = track
+
+    def track(self):
+        return self._track
+
+
+class Particle(object):
+    def __init__(self, particle_id=None, track=None):
+        self._particle_id = particle_id
+        self._proto = ProtoParticle(track)
+        self._momentum = track.momentum() if track is not None else XYZVector()
+
+    def proto(self):
+        return self._proto
+
+    def momentum(self):
+        return self._momentum
+
+
+class Header(object):
+    def __init__(self, run_number, event_number):
+        self._run_number = run_number
+        self._event_number = event_number
+
+    def runNumber(self):
+        return self._run_number
+
+    def evtNumber(self):
+        return self._event_number
+
+
+def make_event(seed, event_number, job_id=0, n_tracks=60, n_pvs=3, dstar_fraction=0.5, distortion=0.):
+    """Build the contents of the event store for a synthetic event, each job has a different run number"""
+    rng = np.random.RandomState([seed, job_id, event_number])
+    pvs = [Vertex(XYZPoint(rng.normal(0, 0.02), rng.normal(0, 0.02), rng.normal(0, 50))) for _ in range(n_pvs)]
+
+    mc_particles = []
+    lines = []
+
+    def add_mc_particle(pid, origin, tx, ty, p, mother=None):
+        pz = p / sqrt(1 + tx**2 + ty**2)
+        mc_particle = MCParticle(len(mc_particles), pid, XYZVector(tx*pz, ty*pz, pz), origin, mother)
+        mc_particles.append(mc_particle)
+        return mc_particle
+
+    # Prompt tracks, and the kaons and pion of a D*+ in some of the events which
+    # are always long tracks so they can be made into particles
+    for _ in range(n_tracks):
+        pv = pvs[rng.randint(n_pvs)].position()
+        tx, ty, p = rng.normal(0, 0.1), rng.normal(0, 0.1), rng.exponential(10000) + 1000
+        long_track = rng.uniform() < 0.7
+        lines.append((pv, tx, ty, p, long_track, add_mc_particle(rng.choice([211, -211, 321, -321]), pv, tx, ty, p)))
+    if rng.uniform() < dstar_fraction:
+        pv = pvs[0].position()
+        dstar = add_mc_particle(413, pv, 0, 0, 50000)
+        d0_vertex = XYZPoint(pv.x() + rng.normal(0, 0.5), pv.y() + rng.normal(0, 0.5), pv.z() + rng.exponential(5))
+        d0 = add_mc_particle(421, pv, 0, 0, 40000, mother=dstar)
+        for pid, origin, mother in [(321, d0_vertex, d0), (-321, d0_vertex, d0), (211, pv, dstar)]:
+            tx, ty, p = rng.normal(0, 0.05), rng.normal(0, 0.05), rng.exponential(10000) + 2000
+            lines.append((origin, tx, ty, p, True, add_mc_particle(pid, origin, tx, ty, p, mother)))
+
+    clusters = {}
+    tracks = []
+    links = {}
+    covariance = np.diag([0.01, 0.01, 1e-6, 1e-6, 1e-8])
+    for origin, tx, ty, p, long_track, mc_particle in lines:
+        lhcb_ids = []
+        for module, z in enumerate(MODULE_Z):
+            if z < origin.z():
+                continue
+            x = origin.x() + tx * (z - origin.z())
+            y = origin.y() + ty * (z - origin.z())
+            # Pick the sensor from the quadrant and a free pixel from the position
+            sensor = 4 * module + (x > 0) + 2 * (y > 0)
+            row, col = int(abs(x) * 20) % 256, int(abs(y) * 20) % 256
+            channel_id = (sensor << 18) | (col << 8) | row
+            while channel_id in clusters:
+                channel_id = (channel_id & ~0xff) | ((channel_id + 1) & 0xff)
+            clusters[channel_id] = Cluster(
+                channel_id, x + rng.normal(0, 0.012) + distortion * module, y + rng.normal(0, 0.012), z
+            )
+            lhcb_ids.append(LHCbID('VP', channel_id))
+        if len(lhcb_ids) < 3:
+            continue
+
+        charge = 1 if mc_particle.particleID().pid() > 0 else -1
+        first_z = min(cluster.z() for cluster in (clusters[i._channel_id] for i in lhcb_ids))
+        states = {}
+        for location, z in [(CLOSEST_TO_BEAM, origin.z()), (FIRST_MEASUREMENT, first_z)]:
+            state = State(origin.x(), origin.y(), origin.z(), tx + rng.normal(0, 1e-4), ty + rng.normal(0, 1e-4), charge / p, covariance)
+            state.move(z)
+            states[location] = state
+        if long_track:
+            track_type = 3
+            lhcb_ids += [LHCbID('UT', i) for i in range(4)] + [LHCbID('FT', i) for i in range(12)]
+        else:
+            track_type = 1
+            del states[FIRST_MEASUREMENT]
+        track = Track(len(tracks), track_type, states, lhcb_ids)
+        tracks.append(track)
+        # Some tracks are ghosts
+        links[track.key()] = [mc_particle] if rng.uniform() < 0.95 else []
+
+    long_tracks = [track for track in tracks if track.type() == 3]
+    return {
+        'Rec/Header': Header(job_id + 1, event_number),
+        'Raw/VP/Clusters': list(clusters.values()),
+        'Rec/Track/Best': tracks,
+        'Rec/Vertex/Primary': pvs,
+        'MC/Particles': mc_particles,
+        'Phys/PreLoadPions/Particles': [Particle(ParticleID(211), track) for track in long_tracks],
+        'Phys/PreLoadKaons/Particles': [Particle(ParticleID(321), track) for track in long_tracks],
+        '_links': links,
+    }
+
+
+class EventStore(object):
+    """The ``evt`` of the mock application manager"""
+    def __init__(self):
+        self.event = {}
+
+    def __getitem__(self, location):
+        if location.startswith('/Event/'):
+            location = location[len('/Event/'):]
+        return self.event.get(location)
+
+
+class ToolSvc(object):
+    def create(self, name, interface=None):
+        return TOOLS[name]()
+
+
+class IOHelper(object):
+    """Records the input files, the job ID is taken from their paths"""
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def inputFiles(self, files):
+        config['inputs'] = list(files)
+
+    def dressFile(self, filename, io):
+        return "DATAFILE='PFN:{}' SVC='Gaudi::RootEvtSelector' OPT='READ'".format(filename)
+
+
+def _job_id(inputs):
+    match = re.search(r'hists/(\d+)/', inputs[0]) if inputs else None
+    return int(match.group(1)) if match else 0
+
+
+class EventSelector(object):
+    def __init__(self, app):
+        self._app = app
+        self.Input = config['inputs']
+        self.FirstEvent = LHCbConfig.lhcbApp.__dict__.get('SkipEvents', 0) + 1
+
+    def reinitialize(self):
+        self._app._job_id = _job_id(self.Input)
+        self._app._next_event = self.FirstEvent - 1
+
+
+class AppMgr(object):
+    """Serves the synthetic events of the job configured by ``install``"""
+    def __init__(self, *args, **kwargs):
+        self._evt = EventStore()
+        self._selector = EventSelector(self)
+        self._selector.reinitialize()
+
+    def evtsvc(self):
+        return self._evt
+
+    def evtsel(self):
+        return self._selector
+
+    def toolsvc(self):
+        return ToolSvc()
+
+    def run(self, n):
+        for _ in range(n):
+            if self._next_event < config['n_events']:
+                self._evt.event = make_event(
+                    config['seed'], self._next_event, self._job_id, n_tracks=config['n_tracks'],
+                    distortion=0. if config['scenario'] == 'Original_DB' else config['distortion']
+                )
+            else:
+                self._evt.event = {}
+            self._next_event += 1
+
+
+class Extrapolator(object):
+    """Straight line replacement for ``TrackParabolicExtrapolator``"""
+    def propagate(self, state, z):
+        state.move(z)
+        return True
+
+
+class LineTraj(object):
+    def __init__(self, position, direction, range_):
+        norm = sqrt(direction.x()**2 + direction.y()**2 + direction.z()**2)
+        self._origin = position
+        self._direction = [direction.x() / norm, direction.y() / norm, direction.z() / norm]
+
+    def position(self, s):
+        s = float(s)
+        return XYZPoint(*(o + s * d for o, d in zip(self._origin._xyz, self._direction)))
+
+
+class TrajPoca(object):
+    """Closed form replacement for ``TrajPoca`` with a ``LineTraj``"""
+    def minimize(self, traj, s, point, residual, precision):
+        s.value = sum((p - o) * d for p, o, d in zip(point._xyz, traj._origin._xyz, traj._direction))
+        intercept = traj.position(s)
+        residual.SetXYZ(*(i - p for i, p in zip(intercept._xyz, point._xyz)))
+        return True
+
+
+class VertexFitter(object):
+    """Puts the vertex at the midpoint of the closest approach of the two tracks"""
+    def fit(self, particle_1, particle_2, vertex, mother):
+        (x1, y1, z1, tx1, ty1), (x2, y2, z2, tx2, ty2) = [
+            _line(particle.proto().track().firstState()) for particle in [particle_1, particle_2]
+        ]
+        # Solve for the z of each line which minimises the distance between them
+        d = np.array([x1 - x2, y1 - y2, z1 - z2])
+        u, v = np.array([tx1, ty1, 1.]), np.array([tx2, ty2, 1.])
+        a, b, c = u.dot(u), u.dot(v), v.dot(v)
+        denominator = a * c - b * b
+        if denominator == 0:
+            return False
+        s1 = (b * v.dot(d) - c * u.dot(d)) / denominator
+        s2 = (a * v.dot(d) - b * u.dot(d)) / denominator
+        p1 = np.array([x1, y1, z1]) + s1 * u
+        p2 = np.array([x2, y2, z2]) + s2 * v
+        vertex._position = XYZPoint(*(p1 + p2) / 2)
+        vertex._chi2 = float(np.sum((p1 - p2)**2) / 0.01)
+        mother._momentum = particle_1.momentum() + particle_2.momentum()
+        return True
+
+
+def _line(state):
+    return state.x(), state.y(), state.z(), state.tx(), state.ty()
+
+
+TOOLS = {
+    'TrajPoca': TrajPoca,
+    'TrackParabolicExtrapolator': Extrapolator,
+    'LoKi::VertexFitter': VertexFitter,
+    'OfflineVertexFitter': VertexFitter,
+}
+
+
+def VIPCHI2(particle, geo):
+    """IP chi2 of the particle's track with respect to a PV"""
+    x, y, z, tx, ty = _line(particle.proto().track().firstState())
+
+    def ipchi2(pv):
+        dz = pv.position().z() - z
+        return ((x + tx*dz - pv.position().x())**2 + (y + ty*dz - pv.position().y())**2) / 0.0001
+    return ipchi2
+
+
+class Algo(object):
+    def __init__(self, name):
+        self.name = name
+
+    def geo(self):
+        return None
+
+
+def linkedTo(target, source, location):
+    """Links from tracks to MC particles of the current event"""
+    return _Linker(_app_evt()['_links'])
+
+
+class _Linker(object):
+    def __init__(self, links):
+        self._links = links or {}
+
+    def range(self, track):
+        return _Range(self._links.get(track.key(), []))
+
+    def first(self, track):
+        return self._links[track.key()][0]
+
+
+class _Range(list):
+    def size(self):
+        return len(self)
+
+
+class _Anything(list):
+    """Value of an unset configurable property, can be appended to or called"""
+    def __call__(self, *args, **kwargs):
+        pass
+
+
+class Configurable(object):
+    """Accepts any property or method used to configure the job"""
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        value = _Anything()
+        setattr(self, name, value)
+        return value
+
+
+config = {'seed': 0, 'n_events': 100, 'n_tracks': 60, 'scenario': 'Original_DB', 'distortion': 0., 'inputs': []}
+
+# Set by install
+LHCbConfig = None
+_app = []
+
+
+def _app_evt():
+    return _app[-1].evtsvc()
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+
+def install(scenario='Original_DB', n_events=100, n_tracks=60, seed=0, distortion=0.01):
+    """Replace the Gaudi and LHCb modules with the mock ones
+
+    Must be called before track_tools or read_xdst is imported, calling it
+    again only changes the events which are served.
+    """
+    global LHCbConfig
+    config.update(scenario=scenario, n_events=n_events, n_tracks=n_tracks, seed=seed, distortion=distortion)
+    if LHCbConfig is not None:
+        # read_xdst.py holds a reference to lhcbApp so reset it in place
+        LHCbConfig.lhcbApp.__dict__.clear()
+        return
+
+    def app_mgr(*args, **kwargs):
+        app = AppMgr()
+        _app.append(app)
+        return app
+
+    track = type('Track', (object,), dict(
+        {name: value for value, name in TRACK_TYPES.items()}, TypesToString=staticmethod(TRACK_TYPES.get)
+    ))
+    state = type('State', (object,), {'ClosestToBeam': CLOSEST_TO_BEAM, 'FirstMeasurement': FIRST_MEASUREMENT})
+    lhcb = _module(
+        'LHCb', Track=track, State=state, LineTraj=LineTraj, Vertex=Vertex, Particle=Particle,
+        ParticleID=ParticleID, MCParticle=MCParticle,
+    )
+    gbl = _module('gbl', LHCb=lhcb, std=_module('std', pair=_pair))
+    LHCbConfig = _module('LHCbConfig', ApplicationMgr=Configurable, lhcbApp=Configurable())
+
+    modules = {
+        'GaudiPython': _module('GaudiPython', gbl=gbl, AppMgr=app_mgr, loaddict=lambda name: None),
+        'ROOT': _module('ROOT', Double=Double),
+        'LHCbMath': _module('LHCbMath', XYZPoint=XYZPoint, XYZVector=XYZVector),
+        'LoKiAlgo': _module('LoKiAlgo'),
+        'LoKiAlgo.decorators': _module('LoKiAlgo.decorators', Algo=Algo),
+        'LoKiPhys': _module('LoKiPhys'),
+        'LoKiPhys.decorators': _module('LoKiPhys.decorators', VIPCHI2=VIPCHI2),
+        'LinkerInstances': _module('LinkerInstances'),
+        'LinkerInstances.eventassoc': _module('LinkerInstances.eventassoc', linkedTo=linkedTo),
+        'Configurables': _module('Configurables', **{
+            name: Configurable
+            for name in ['CondDB', 'CondDBAccessSvc', 'GaudiSequencer', 'NoPIDsParticleMaker', 'PrPixelStoreClusters']
+        }),
+        'GaudiConf': _module('GaudiConf', IOHelper=IOHelper),
+        'LHCbConfig': LHCbConfig,
+    }
+    modules['LoKiAlgo'].decorators = modules['LoKiAlgo.decorators']
+    modules['LoKiPhys'].decorators = modules['LoKiPhys.decorators']
+    modules['LinkerInstances'].eventassoc = modules['LinkerInstances.eventassoc']
+    sys.modules.update(modules)
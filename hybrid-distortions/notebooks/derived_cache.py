@@ -0,0 +1,131 @@
+"""Content addressed on-disk cache of the derived columns added by utils.load
+
+Each entry holds the values of a column for the rows of one file and is keyed
+by the hash of the file's contents and the hash of the code deriving the
+column, so an entry can't be used once either of them changes. The entries of
+a file which has been rewritten, or of an old version of a derivation, are
+removed as soon as they're superseded and the least recently used entries are
+removed once the cache is larger than <max_bytes>.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+import hashlib
+import json
+import os
+from os.path import abspath, isfile, join
+import shutil
+
+import numpy as np
+
+CACHE_DIR = 'output/derived_cache'
+MAX_BYTES = 4 * 1024**3
+
+def _hash_file(fn):
+    sha1 = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def code_hash(code):
+    return hashlib.sha1(code.encode('utf-8')).hexdigest()[:16]
+
+class DerivedColumnCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @property
+    def _hashes_fn(self):
+        return join(self.directory, 'file_hashes.json')
+
+    def file_hashes(self, filenames):
+        """Return a dictionary of filename to the hash of its contents
+
+        The hashes are remembered by path, size and modification time so each
+        file is only read once after it's written.
+        """
+        known = {}
+        if isfile(self._hashes_fn):
+            with open(self._hashes_fn) as f:
+                known = json.load(f)
+
+        stats = {fn: os.stat(fn) for fn in filenames}
+        keys = {fn: [stat.st_size, stat.st_mtime_ns] for fn, stat in stats.items()}
+        changed = [fn for fn in filenames if known.get(abspath(fn), {}).get('stat') != keys[fn]]
+        if changed:
+            with ThreadPoolExecutor() as pool:
+                new_hashes = dict(zip(changed, pool.map(_hash_file, changed)))
+            for fn in changed:
+                previous = known.get(abspath(fn))
+                if previous is not None and previous['hash'] != new_hashes[fn]:
+                    # The file was rewritten so its entries are stale
+                    shutil.rmtree(join(self.directory, previous['hash']), ignore_errors=True)
+                known[abspath(fn)] = {'stat': keys[fn], 'hash': new_hashes[fn]}
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._hashes_fn + '.tmp', 'w') as f:
+                json.dump(known, f)
+            os.replace(self._hashes_fn + '.tmp', self._hashes_fn)
+
+        return {fn: known[abspath(fn)]['hash'] for fn in filenames}
+
+    def _entry_fn(self, file_hash, column, code):
+        return join(self.directory, file_hash, f'{column}-{code_hash(code)}.npy')
+
+    def get(self, file_hash, column, code):
+        """Return the cached values of <column> derived by <code> or None"""
+        fn = self._entry_fn(file_hash, column, code)
+        try:
+            values = np.load(fn)
+            # Mark the entry as recently used
+            os.utime(fn)
+        except FileNotFoundError:
+            # Also happens if it was evicted by another process
+            return None
+        return values
+
+    def put(self, file_hash, column, code, values):
+        fn = self._entry_fn(file_hash, column, code)
+        # Remove the entries of other versions of the derivation
+        for old_fn in glob(join(self.directory, file_hash, f'{column}-*.npy')):
+            if old_fn != fn:
+                try:
+                    os.remove(old_fn)
+                except FileNotFoundError:
+                    pass
+        os.makedirs(join(self.directory, file_hash), exist_ok=True)
+        # Write to a file object so numpy doesn't append ".npy"
+        with open(fn + '.tmp', 'wb') as f:
+            np.save(f, np.asarray(values))
+        os.replace(fn + '.tmp', fn)
+
+    def size(self):
+        return sum(os.path.getsize(fn) for fn in glob(join(self.directory, '*', '*.npy')))
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is smaller than <max_bytes>"""
+        entries = []
+        for fn in glob(join(self.directory, '*', '*.npy')):
+            try:
+                stat = os.stat(fn)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fn))
+        total = sum(size for mtime, size, fn in entries)
+        for mtime, size, fn in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                pass
+            total -= size
+        for dn in glob(join(self.directory, '*')):
+            try:
+                os.rmdir(dn)
+            except OSError:
+                # Not empty
+                pass
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,244 @@
+"""N-dimensional histograms which are filled in chunks, merged and saved
+
+Plots are made from the histograms rather than from the tables, so once the
+histograms of each scenario have been filled (e.g. with ``utils.iter_chunks``
+and ``utils.reduce_chunks``, as they have the same ``fill`` and ``merge``
+methods as the reducers) and saved, figures can be restyled without reading
+the tables again::
+
+    hists = utils.reduce_chunks(
+        utils.iter_chunks('residuals', columns=['residual_x']),
+        {'residual_x': histograms.Histogram([histograms.Axis('residual_x', 100, (-0.1, 0.1))])},
+    )
+    histograms.save('residual_x.npz', {s: h['residual_x'] for s, h in hists.items()})
+    histograms.plot_scenarios(histograms.load('residual_x.npz'), density=True)
+"""
+import json
+
+import numpy as np
+from matplotlib import pyplot as plt
+
+class Axis:
+    """Binning of one dimension of a histogram
+
+    <bins> is either the number of equal width bins in <range> or the bin
+    edges. <column> is a column name or an expression for ``DataFrame.eval``.
+    As for ``np.histogram`` the last bin includes its upper edge and values
+    outside the edges aren't counted.
+    """
+    def __init__(self, column, bins, range=None, label=None):
+        self.column = column
+        self.label = column if label is None else label
+        if np.ndim(bins) == 0:
+            if range is None:
+                raise ValueError('A range is needed for equal width bins')
+            self.edges = np.linspace(range[0], range[1], bins+1)
+            self.uniform = True
+        else:
+            self.edges = np.asarray(bins, dtype=np.float64)
+            if np.any(np.diff(self.edges) <= 0):
+                raise ValueError('Bin edges must be increasing')
+            self.uniform = False
+
+    @property
+    def n_bins(self):
+        return len(self.edges) - 1
+
+    @property
+    def centres(self):
+        return (self.edges[1:] + self.edges[:-1]) / 2
+
+    def __eq__(self, other):
+        return self.column == other.column and np.array_equal(self.edges, other.edges)
+
+    def index(self, values):
+        """Return the bin of each value, or -1 if it's outside the edges or NaN"""
+        values = np.asarray(values, dtype=np.float64)
+        low, high = self.edges[0], self.edges[-1]
+        inside = (values >= low) & (values <= high)
+        if self.uniform:
+            index = np.floor((values - low) * (self.n_bins / (high - low)))
+            index = np.clip(np.where(inside, index, 0), 0, self.n_bins-1).astype(np.intp)
+            # Correct for rounding so the bins agree with the edges
+            index -= values < self.edges[index]
+            index += (values >= self.edges[index+1]) & (index < self.n_bins-1)
+        else:
+            index = np.clip(np.searchsorted(self.edges, values, side='right') - 1, 0, self.n_bins-1)
+        index[~inside] = -1
+        return index
+
+    def to_dict(self):
+        return {'column': self.column, 'label': self.label, 'uniform': self.uniform}
+
+class Histogram:
+    """Counts of the rows of a table in the bins of <axes>
+
+    <query> optionally selects the rows and <weight> is an optional column or
+    expression to weight them by, in which case the sum of the squared weights
+    is also kept for the uncertainties.
+    """
+    def __init__(self, axes, query=None, weight=None):
+        self.axes = list(axes)
+        self.query = query
+        self.weight = weight
+        self.counts = np.zeros(self.shape, dtype=np.int64 if weight is None else np.float64)
+        self.sumw2 = None if weight is None else np.zeros(self.shape, dtype=np.float64)
+
+    @property
+    def shape(self):
+        return tuple(axis.n_bins for axis in self.axes)
+
+    @property
+    def edges(self):
+        """The bin edges of a 1D histogram or a list of them"""
+        edges = [axis.edges for axis in self.axes]
+        return edges[0] if len(edges) == 1 else edges
+
+    @property
+    def result(self):
+        return self.counts, self.edges
+
+    @staticmethod
+    def _column(df, column):
+        values = df[column] if column in df else df.eval(column)
+        return np.asarray(values, dtype=np.float64)
+
+    def fill(self, df):
+        """Add the rows of a DataFrame"""
+        if self.query is not None:
+            df = df.query(self.query)
+        weights = None if self.weight is None else self._column(df, self.weight)
+        self.fill_arrays(*[self._column(df, axis.column) for axis in self.axes], weights=weights)
+
+    def fill_arrays(self, *values, weights=None):
+        """Add the values of each axis given as arrays"""
+        if len(values) != len(self.axes):
+            raise ValueError(f'Expected values for {len(self.axes)} axes')
+        if (weights is None) != (self.weight is None):
+            raise ValueError('Weights must be given if and only if the histogram is weighted')
+        indices = [axis.index(v) for axis, v in zip(self.axes, values)]
+        valid = np.logical_and.reduce([index >= 0 for index in indices])
+        flat = np.ravel_multi_index([index[valid] for index in indices], self.shape)
+        size = self.counts.size
+        if weights is None:
+            self.counts += np.bincount(flat, minlength=size).reshape(self.shape)
+        else:
+            weights = np.asarray(weights, dtype=np.float64)[valid]
+            self.counts += np.bincount(flat, weights=weights, minlength=size).reshape(self.shape)
+            self.sumw2 += np.bincount(flat, weights=weights**2, minlength=size).reshape(self.shape)
+
+    def _check_compatible(self, other):
+        if self.axes != other.axes or self.query != other.query or self.weight != other.weight:
+            raise ValueError('Histograms have different bins, queries or weights')
+
+    def merge(self, other):
+        """Add the counts of a histogram with the same bins, e.g. of another file or scenario"""
+        self._check_compatible(other)
+        self.counts += other.counts
+        if self.sumw2 is not None:
+            self.sumw2 += other.sumw2
+        return self
+
+    def copy(self):
+        histogram = Histogram(self.axes, self.query, self.weight)
+        histogram.merge(self)
+        return histogram
+
+    def __add__(self, other):
+        return self.copy().merge(other)
+
+    def __radd__(self, other):
+        # Allow sum(histograms)
+        return self.copy() if other == 0 else self + other
+
+    def project(self, *axes):
+        """Sum over all but <axes>, given as indices or column names"""
+        columns = [axis.column for axis in self.axes]
+        keep = [columns.index(a) if isinstance(a, str) else a for a in axes]
+        summed = tuple(i for i in range(len(self.axes)) if i not in keep)
+        histogram = Histogram([self.axes[i] for i in keep], self.query, self.weight)
+        order = np.argsort(np.argsort(keep))
+        histogram.counts = np.transpose(self.counts.sum(axis=summed), order)
+        if self.sumw2 is not None:
+            histogram.sumw2 = np.transpose(self.sumw2.sum(axis=summed), order)
+        return histogram
+
+    def density(self):
+        """Counts divided by the total and the bin volume, like ``density=True`` for ``np.histogram``"""
+        volume = np.ones(self.shape)
+        for i, axis in enumerate(self.axes):
+            shape = [1] * len(self.axes)
+            shape[i] = axis.n_bins
+            volume = volume * np.diff(axis.edges).reshape(shape)
+        total = self.counts.sum()
+        return self.counts / volume / total if total else np.zeros(self.shape)
+
+    def errors(self):
+        return np.sqrt(self.counts if self.sumw2 is None else self.sumw2)
+
+    def to_arrays(self, prefix=''):
+        arrays = {f'{prefix}counts': self.counts}
+        if self.sumw2 is not None:
+            arrays[f'{prefix}sumw2'] = self.sumw2
+        for i, axis in enumerate(self.axes):
+            arrays[f'{prefix}edges_{i}'] = axis.edges
+        metadata = {'axes': [axis.to_dict() for axis in self.axes], 'query': self.query, 'weight': self.weight}
+        arrays[f'{prefix}metadata'] = np.array(json.dumps(metadata))
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        metadata = json.loads(str(arrays[f'{prefix}metadata']))
+        axes = []
+        for i, axis in enumerate(metadata['axes']):
+            edges = arrays[f'{prefix}edges_{i}']
+            if axis['uniform']:
+                axes.append(Axis(axis['column'], len(edges)-1, (edges[0], edges[-1]), axis['label']))
+            else:
+                axes.append(Axis(axis['column'], edges, label=axis['label']))
+        histogram = cls(axes, metadata['query'], metadata['weight'])
+        histogram.counts = arrays[f'{prefix}counts']
+        if histogram.sumw2 is not None:
+            histogram.sumw2 = arrays[f'{prefix}sumw2']
+        return histogram
+
+    def plot(self, ax=None, density=False, **kwargs):
+        """Draw a 1D histogram as with ``Series.hist`` or a 2D histogram with ``pcolormesh``"""
+        ax = plt.gca() if ax is None else ax
+        values = self.density() if density else self.counts
+        if len(self.axes) == 1:
+            kwargs.setdefault('histtype', 'step')
+            result = ax.hist(self.axes[0].centres, bins=self.axes[0].edges, weights=values, **kwargs)
+            ax.set_xlabel(self.axes[0].label)
+        elif len(self.axes) == 2:
+            result = ax.pcolormesh(self.axes[0].edges, self.axes[1].edges, values.T, **kwargs)
+            ax.set_xlabel(self.axes[0].label)
+            ax.set_ylabel(self.axes[1].label)
+        else:
+            raise ValueError('Only 1D and 2D histograms can be plotted, use project() first')
+        return result
+
+def save(fn, histograms):
+    """Save a dictionary of name (e.g. scenario) to histogram to a single file"""
+    arrays = {'names': np.array(json.dumps(list(histograms)))}
+    for i, histogram in enumerate(histograms.values()):
+        arrays.update(histogram.to_arrays(f'{i}/'))
+    # Write to a file object so numpy doesn't append ".npz"
+    with open(fn, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+def load(fn):
+    with np.load(fn) as arrays:
+        names = json.loads(str(arrays['names']))
+        return {name: Histogram.from_arrays(arrays, f'{i}/') for i, name in enumerate(names)}
+
+def plot_scenarios(histograms, ax=None, label=None, density=False, **kwargs):
+    """Overlay the 1D histogram of each scenario
+
+    <label> optionally converts a scenario to its label, e.g. ``utils.format_label``.
+    """
+    ax = plt.gca() if ax is None else ax
+    for scenario, histogram in histograms.items():
+        histogram.plot(ax, density=density, label=scenario if label is None else label(scenario), **kwargs)
+    ax.legend()
+    return ax
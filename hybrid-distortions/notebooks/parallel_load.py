@@ -0,0 +1,137 @@
+"""Load tables with a pool of processes which decode straight into shared memory
+
+The number of rows of every file is known from the catalog, so a buffer for
+each column of a table can be allocated up front in shared memory. Every
+(scenario, file) is then read by a worker process which writes its rows at
+their offset in the buffers, and the DataFrame is built on top of the buffers
+without copying them. The rows of each scenario are contiguous and in the
+order of the scenarios.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import table_io
+import table_schema
+
+# Buffers are memory mapped files in here so they're freed once the DataFrame
+# is, the temporary directory is used if there isn't enough room
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+def _buffer_dtype(df_name, column):
+    """Categorical columns are stored as their codes"""
+    dtype = table_schema.SCHEMAS[df_name][column]
+    return np.dtype(np.int8 if dtype == 'category' else dtype)
+
+def _read_into(fn, df_name, buffers, start, n_rows):
+    """Read a file and write its columns to rows ``start`` to ``start + n_rows`` of <buffers>
+
+    <buffers> maps each column to the path and dtype of its buffer.
+    """
+    df = table_schema.cast(df_name, table_io.read_table(fn, columns=list(buffers)))
+    if len(df) != n_rows:
+        raise ValueError(f'{fn} has {len(df)} rows but the catalog has {n_rows}, rebuild it with catalog.load(rebuild=True)')
+    if not n_rows:
+        return
+    for column, (path, dtype) in buffers.items():
+        dtype = np.dtype(dtype)
+        values = df[column].cat.codes if isinstance(df[column].dtype, pd.CategoricalDtype) else df[column]
+        buffer = np.memmap(path, dtype=dtype, mode='r+', offset=start*dtype.itemsize, shape=(n_rows,))
+        buffer[:] = np.asarray(values)
+        buffer.flush()
+        del buffer
+
+def _buffer_dir(n_bytes):
+    """Return a directory with room for <n_bytes> of buffers, preferring shared memory
+
+    Writing to a sparse file in a full directory kills the worker with SIGBUS
+    so the space is checked before reading anything.
+    """
+    directories = [d for d in [SHM_DIR, tempfile.gettempdir()] if d is not None]
+    for directory in directories:
+        stat = os.statvfs(directory)
+        if stat.f_bavail * stat.f_frsize >= n_bytes:
+            return directory
+    raise RuntimeError(
+        f'Not enough space for {n_bytes/1024**2:.0f} MB of buffers in {" or ".join(directories)}, '
+        'load fewer scenarios, jobs or columns'
+    )
+
+def _allocate(directory, dtype, n_rows):
+    fd, path = tempfile.mkstemp(prefix='hybrid_distortions_', dir=directory)
+    try:
+        os.ftruncate(fd, n_rows*dtype.itemsize)
+    finally:
+        os.close(fd)
+    return path, np.memmap(path, dtype=dtype, mode='r+', shape=(n_rows,))
+
+def _build_dataframe(df_name, columns, arrays, scenarios, scenario_rows):
+    data = {}
+    for column in columns:
+        if table_schema.SCHEMAS[df_name][column] == 'category':
+            data[column] = pd.Categorical.from_codes(arrays[column], categories=table_schema.CATEGORIES[column])
+        else:
+            data[column] = arrays[column]
+    codes = np.repeat(np.arange(len(scenarios), dtype=np.int16), scenario_rows)
+    data['scenario'] = pd.Categorical.from_codes(codes, categories=scenarios)
+    return pd.DataFrame(data, copy=False)
+
+def load_tables(tables, scenarios, n_workers=None):
+    """Read several tables at once, returning a dictionary of table name to DataFrame
+
+    <tables> maps each table name to ``(files, columns)``, where <files> maps
+    each scenario to a list of ``(filename, n_rows)`` and <columns> are the
+    stored columns to read (or None for all of them). The files of all tables
+    are shared between <n_workers> processes, by default one per core.
+    """
+    plans = {}
+    for df_name, (files, columns) in tables.items():
+        columns = table_schema.COLUMNS[df_name] if columns is None else columns
+        scenario_rows = [sum(n_rows for fn, n_rows in files[scenario]) for scenario in scenarios]
+        plans[df_name] = (files, columns, scenario_rows)
+    directory = _buffer_dir(sum(
+        sum(scenario_rows) * sum(_buffer_dtype(df_name, column).itemsize for column in columns)
+        for df_name, (files, columns, scenario_rows) in plans.items()
+    ))
+
+    paths = []
+    try:
+        arrays = {}
+        tasks = []
+        for df_name, (files, columns, scenario_rows) in plans.items():
+            n_total = sum(scenario_rows)
+            arrays[df_name] = {}
+            buffers = {}
+            for column in columns:
+                dtype = _buffer_dtype(df_name, column)
+                if n_total:
+                    path, buffer = _allocate(directory, dtype, n_total)
+                    paths.append(path)
+                    # Drop the memmap subclass, the array keeps the mapping open
+                    arrays[df_name][column] = np.asarray(buffer)
+                    buffers[column] = (path, dtype.str)
+                else:
+                    arrays[df_name][column] = np.empty(0, dtype=dtype)
+                    buffers[column] = (None, dtype.str)
+            start = 0
+            for scenario in scenarios:
+                for fn, n_rows in files[scenario]:
+                    tasks.append((fn, df_name, buffers, start, n_rows))
+                    start += n_rows
+
+        n_workers = min(n_workers or os.cpu_count(), len(tasks)) or 1
+        with ProcessPoolExecutor(n_workers) as pool:
+            for future in [pool.submit(_read_into, *task) for task in tasks]:
+                future.result()
+    finally:
+        # The mappings stay valid after the files are removed
+        for path in paths:
+            os.remove(path)
+
+    return {
+        df_name: _build_dataframe(df_name, columns, arrays[df_name], scenarios, scenario_rows)
+        for df_name, (files, columns, scenario_rows) in plans.items()
+    }
@@ -0,0 +1,101 @@
+"""Recompute residuals and impact parameters from the stored track states
+
+The states table contains the reference state of every track (see
+``track_tools.state_to_use``). In the VELO the tracks are straight lines so
+intercepts, residuals and IPs can be calculated for all tracks at once with
+numpy instead of rerunning read_xdst.py. The IPs can only be calculated for
+tracks whose reference state is in the VELO.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Allow the modules used by read_xdst.py to be imported
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))  # NOQA
+import table_schema
+
+TRACK_INDEX = ['run_number', 'event_number', 'track_number']
+EVENT_INDEX = ['run_number', 'event_number']
+
+def _array(series):
+    return np.asarray(series, dtype=np.float64)
+
+def line_positions(states, z):
+    """Return the x and y of each track at ``z``"""
+    dz = _array(z) - _array(states.z)
+    return _array(states.x) + _array(states.tx)*dz, _array(states.y) + _array(states.ty)*dz
+
+def poca(x0, y0, z0, tx, ty, px, py, pz):
+    """Point of closest approach of straight lines to points
+
+    Returns ``(intercept, residual)`` where each is a tuple of x, y and z
+    arrays. As with ``TrajPoca`` the residual is the intercept minus the point.
+    """
+    t = ((px - x0)*tx + (py - y0)*ty + (pz - z0)) / (1 + tx**2 + ty**2)
+    intercept = (x0 + t*tx, y0 + t*ty, z0 + t)
+    residual = (intercept[0] - px, intercept[1] - py, intercept[2] - pz)
+    return intercept, residual
+
+def residuals(states, hits, clusters, prefix=''):
+    """Calculate the residual of every hit with respect to the positions in ``clusters``
+
+    <hits> has one row per hit with the columns of the residuals table which
+    identify the track and cluster. <clusters> can be the clusters table of any
+    scenario. The columns of the returned DataFrame are those of the residuals
+    table, with <prefix> added (e.g. ``'true_'``), and it has the index of <hits>.
+    """
+    df = hits[TRACK_INDEX + ['cluster_channel_id']].merge(
+        states[TRACK_INDEX + ['x', 'y', 'z', 'tx', 'ty']], on=TRACK_INDEX, how='left'
+    ).merge(
+        clusters[EVENT_INDEX + ['channel_id', 'x', 'y', 'z']].rename(columns={
+            'channel_id': 'cluster_channel_id', 'x': 'point_x', 'y': 'point_y', 'z': 'point_z'
+        }),
+        on=EVENT_INDEX + ['cluster_channel_id'], how='left'
+    )
+    intercept, residual = poca(
+        _array(df.x), _array(df.y), _array(df.z), _array(df.tx), _array(df.ty),
+        _array(df.point_x), _array(df.point_y), _array(df.point_z)
+    )
+    result = {}
+    for i, c in enumerate('xyz'):
+        result[f'{prefix}intercept_{c}'] = intercept[i].astype(np.float32)
+    for i, c in enumerate('xyz'):
+        result[f'{prefix}residual_{c}'] = residual[i].astype(np.float32)
+    return pd.DataFrame(result, index=hits.index)
+
+def impact_parameters(states, pvs):
+    """Calculate the IP of every track with respect to the nearest PV
+
+    <pvs> is the pvs table written by read_xdst.py. As in
+    ``track_tools.Track.ip`` the nearest PV is the one with the smallest
+    transverse distance to the track at the z of the PV.
+    Returns a DataFrame of IP3D, IPx and IPy with the index of <states>.
+
+    The tracks are extrapolated as straight lines so the IPs of Downstream
+    and T tracks, whose reference state is after the magnet, are left as NaN
+    (see ``table_schema.VELO_TRACK_TYPES``). ``Track.ip`` extrapolates the
+    first state of the track while this uses the stored reference state, so
+    the IPs of the other tracks differ slightly from those in the tracks table.
+    """
+    if 'track_type' not in states:
+        raise ValueError('The states table has no track types, it was written before schema version 5')
+    df = states[TRACK_INDEX + ['x', 'y', 'z', 'tx', 'ty']].reset_index(drop=True)
+    df['row'] = np.arange(len(df))
+    df = df[np.asarray(states.track_type.isin(table_schema.VELO_TRACK_TYPES))]
+    df = df.merge(pvs[EVENT_INDEX + ['x', 'y', 'z']].rename(columns={c: 'pv_' + c for c in 'xyz'}), on=EVENT_INDEX)
+
+    x, y = line_positions(df, df.pv_z)
+    df['IPx'] = x - _array(df.pv_x)
+    df['IPy'] = y - _array(df.pv_y)
+    df['distance'] = np.hypot(df.IPx, df.IPy)
+    df = df.loc[df.groupby('row').distance.idxmin()]
+
+    # Tracks in events without a PV or outside the VELO are left as NaN
+    result = {c: np.full(len(states), np.nan, dtype=np.float32) for c in ['IP3D', 'IPx', 'IPy']}
+    rows = df.row.values
+    result['IPx'][rows] = df.IPx
+    result['IPy'][rows] = df.IPy
+    result['IP3D'][rows] = np.sqrt((df.IPx**2 + df.IPy**2) / (1 + df.tx**2 + df.ty**2))
+    return pd.DataFrame(result, index=states.index, columns=['IP3D', 'IPx', 'IPy'])
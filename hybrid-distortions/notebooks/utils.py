@@ -1,16 +1,62 @@
-from glob import glob
+from collections import OrderedDict
+from copy import deepcopy
 from itertools import tee
 from functools import wraps
+import inspect
 import os
+import re
+import sys
 
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
-from joblib import delayed, Parallel
+
+# Allow the modules used by read_xdst.py to be imported
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))  # NOQA
+import catalog
+from derived_cache import DerivedColumnCache
+import histograms
+import parallel_load
+import table_io
+import table_schema
 
 D0_mass = 1864.84
 speed_of_light = 299792458
 
+# Columns calculated by load() from the stored columns, as (name, expression)
+DERIVED_COLUMNS = {
+    'tracks': [
+        ('p', 'sqrt(px**2 + py**2 + pz**2)'),
+        ('pt', 'sqrt(px**2 + py**2)'),
+        ('true_p', 'sqrt(true_px**2 + true_py**2 + true_pz**2)'),
+        ('true_pt', 'sqrt(true_px**2 + true_py**2)'),
+    ],
+    'particles': [
+        ('fd', 'sqrt((vertex_x - pv_x)**2 + (vertex_y - pv_y)**2 + (vertex_z - pv_z)**2)'),
+        ('half_true_fd', 'sqrt('
+            '(vertex_x - true_dst_vertex_x)**2 + '
+            '(vertex_y - true_dst_vertex_y)**2 + '
+            '(vertex_z - true_dst_vertex_z)**2'
+        ')'),
+        ('true_fd', 'sqrt('
+            '(true_d0_vertex_x - true_dst_vertex_x)**2 + '
+            '(true_d0_vertex_y - true_dst_vertex_y)**2 + '
+            '(true_d0_vertex_z - true_dst_vertex_z)**2'
+        ')'),
+        ('D0_p', 'sqrt(D0_p_x**2 + D0_p_y**2 + D0_p_z**2)'),
+        ('D0_gamma', f'1/sqrt(1 + D0_p**2/{D0_mass**2})'),
+        ('D0_true_p', 'sqrt(D0_true_p_x**2 + D0_true_p_y**2 + D0_true_p_z**2)'),
+        ('D0_true_gamma', f'1/sqrt(1 + D0_true_p**2/{D0_mass**2})'),
+    ],
+}
+
+# Only the jobs with an ID below these are read by load() and iter_chunks() by
+# default, pass max_jobs to read more
+MAX_JOBS = {'particles': 62, 'clusters': 10, 'tracks': 10, 'residuals': 10, 'states': 10, 'pvs': 10}
+
+# Derived columns calculated by load() are kept here, see derived_cache.py
+DERIVED_CACHE = DerivedColumnCache()
+
 # Change the default settings for plotting
 # os.environ['PATH'] = '/pc2014-data3/cburr/texlive/2016/bin/x86_64-linux/:' + os.environ['PATH']
 # plt.rcParams['figure.dpi'] = 100
@@ -29,7 +75,7 @@ speed_of_light = 299792458
 # """
 
 # Do some monkey patching to fix pandas/#15296
-if not hasattr(pd.read_msgpack, 'read_msgpack'):
+if hasattr(pd, 'read_msgpack') and not hasattr(pd.read_msgpack, 'read_msgpack'):
     @wraps(pd.read_msgpack)
     def read_msgpack(*args, **kwargs):
         df = read_msgpack.read_msgpack(*args, **kwargs)
@@ -48,76 +94,307 @@ def pairwise(iterable):
     next(b, None)
     return zip(a, b)
 
-def _load(df_name, scenarios, n_files):
-    dfs = []
+def _expression_inputs(expression):
+    return set(re.findall(r'[A-Za-z_]\w*', expression)) - {'sqrt'}
+
+def _required_columns(df_name, columns):
+    """Find the stored columns needed to provide ``columns``, including derived ones"""
+    derived = dict(DERIVED_COLUMNS.get(df_name, []))
+    required = []
+    for column in columns:
+        if column in derived:
+            required.extend(_required_columns(df_name, sorted(_expression_inputs(derived[column]))))
+        elif column == 'station':
+            required.append('module')
+        elif column != 'scenario':
+            required.append(column)
+    return list(OrderedDict.fromkeys(required))
+
+def _station(df):
+    return pd.to_numeric(np.floor_divide(df.module, 2), downcast='unsigned')
+
+def _derivations(df_name, columns):
+    """Return the ``(column, code, derive)`` of each derived column which can be calculated from <columns>
+
+    The columns are in the order they have to be added, ``derive(df)``
+    returns the values of the column and <code> identifies the derivation,
+    including the derivations of the derived columns it uses.
+    """
+    derivations = []
+    codes = {}
+    if df_name == 'residuals' and 'module' in columns:
+        codes['station'] = inspect.getsource(_station)
+        derivations.append(('station', codes['station'], _station))
+    for column, expression in DERIVED_COLUMNS.get(df_name, []):
+        inputs = _expression_inputs(expression)
+        if inputs.issubset(set(columns) | set(codes)):
+            codes[column] = expression + ''.join(codes[c] for c in sorted(inputs) if c in codes)
+            derivations.append((column, codes[column], lambda df, expression=expression: df.eval(expression)))
+    return derivations
+
+def _add_derived_columns(df_name, df):
+    for column, code, derive in _derivations(df_name, df.columns):
+        df[column] = derive(df)
+    if 'station' in df:
+        df['station'] = df['station'].astype('category')
+
+def _add_cached_derived_columns(df_name, df, filenames, n_rows, cache):
+    """Add the derived columns to a table read from <filenames>, which have <n_rows> each
+
+    The values for the rows of each file are read from <cache> if they have
+    been calculated before, otherwise they are calculated and saved.
+    """
+    derivations = _derivations(df_name, df.columns)
+    if not derivations:
+        # Don't hash the files of tables without derived columns
+        return
+    bounds = np.cumsum([0] + n_rows)
+    hashes = cache.file_hashes(filenames)
+    for column, code, derive in derivations:
+        parts = []
+        for fn, start, stop in zip(filenames, bounds[:-1], bounds[1:]):
+            values = cache.get(hashes[fn], column, code)
+            if values is None or len(values) != stop - start:
+                values = np.asarray(derive(df.iloc[start:stop]))
+                cache.put(hashes[fn], column, code, values)
+            parts.append(values)
+        df[column] = np.concatenate(parts)
+    if 'station' in df:
+        df['station'] = df['station'].astype('category')
+    cache.evict()
+
+def _plan_files(output_catalog, df_name, scenarios, fast, max_jobs=None):
+    """Return a dictionary of scenario to the ``(job_id, filename, n_rows)`` of each file to read
+
+    Only the jobs with an ID below <max_jobs> are read, by default the limit
+    from ``MAX_JOBS`` and 1 if <fast> is True.
+    """
+    if max_jobs is None:
+        max_jobs = 1 if fast else MAX_JOBS.get(df_name, 10)
+    files = {}
     for scenario in scenarios:
-        valid = False
-        for i in range(n_files):
-            fn = f'output/scenarios/{scenario}/{df_name}_{i}.msg'
-            if os.path.isfile(fn):
-                df = pd.read_msgpack(fn)
-                df['scenario'] = pd.Categorical([scenario]*len(df), categories=scenarios)
-                dfs.append(df)
-                valid = True
-        if not valid:
+        job_ids = [job_id for job_id in output_catalog.job_ids(scenario, df_name) if job_id < max_jobs]
+        if not job_ids:
             raise ValueError(scenario, df_name)
-    return df_name, pd.concat(dfs)
+        files[scenario] = [
+            (job_id, output_catalog.filename(scenario, df_name, job_id), output_catalog.entry(scenario, df_name, job_id)['rows'])
+            for job_id in job_ids
+        ]
+    return files
+
+def load(scenarios=None, names=['clusters', 'tracks', 'residuals', 'particles'], fast=False, columns=None, n_workers=None,
+         cache=True, max_jobs=None):
+    """Load the tables produced by read_xdst.py
 
-def load(scenarios=None, names=['clusters', 'tracks', 'residuals', 'particles'], fast=False):
+    <columns> can be used to only read some of the columns, given as a
+    dictionary of table name to column names. Derived columns (such as ``p``)
+    can be requested and the columns needed to calculate them will be read.
+    The files to read are taken from the catalog kept by read_xdst.py, which
+    is built from the output directory if it doesn't exist yet. Each file
+    is read by one of <n_workers> processes (by default one per core), see
+    ``parallel_load``. The derived columns are cached in ``DERIVED_CACHE``
+    unless <cache> is False. The jobs with an ID below <max_jobs> are read,
+    by default the limit for each table in ``MAX_JOBS`` or 1 if <fast> is True.
+    """
+    output_catalog = catalog.load()
     if scenarios is None:
-        scenarios = []
-        for scenario in glob('output/scenarios/*/particles_0.msg'):
-            scenarios.append(scenario[len('output/scenarios/'):-len('/particles_0.msg')])
+        scenarios = output_catalog.scenarios('particles')
 
-    data = Parallel(n_jobs=4, backend='threading')(
-        delayed(_load)(n, scenarios, [62 if n == 'particles' else 10, 1][fast]) for n in names
-    )
-    data = dict(data)
+    if columns is None:
+        columns = {}
 
-    if 'residuals' in names:
-        data['residuals']['station'] = np.floor_divide(data['residuals'].module, 2)
-        try:
-            data['residuals']['station'] = pd.to_numeric(data['residuals']['station'], downcast='unsigned')
-            data['residuals']['station'] = data['residuals']['station'].astype('category')
-        except Exception:
-            raise Exception(repr(data['residuals']['station'])+'\n'+repr(np.unique(data['residuals']['station'])))
-        data['residuals'] = {k: v for k, v in data['residuals'].groupby('scenario')}
-
-    if 'tracks' in names:
-        data['tracks'].track_type = list(map(lambda s: s.decode('utf-8'), data['tracks'].track_type))
-        data['tracks'].track_type = data['tracks'].track_type.astype('category')
-
-        data['tracks'].eval('p = sqrt(px**2 + py**2 + pz**2)', inplace=True)
-        data['tracks'].eval('pt = sqrt(px**2 + py**2)', inplace=True)
-        data['tracks'].eval('true_p = sqrt(true_px**2 + true_py**2 + true_pz**2)', inplace=True)
-        data['tracks'].eval('true_pt = sqrt(true_px**2 + true_py**2)', inplace=True)
-
-    if 'particles' in names:
-        data['particles'].eval('fd = sqrt('
-            '(vertex_x - pv_x)**2 + '
-            '(vertex_y - pv_y)**2 + '
-            '(vertex_z - pv_z)**2'
-        ')', inplace=True)
-
-        data['particles'].eval('half_true_fd = sqrt('
-            '(vertex_x - true_dst_vertex_x)**2 + '
-            '(vertex_y - true_dst_vertex_y)**2 + '
-            '(vertex_z - true_dst_vertex_z)**2'
-        ')', inplace=True)
+    tables = {}
+    for n in names:
+        files = _plan_files(output_catalog, n, scenarios, fast, max_jobs)
+        files = {scenario: [(fn, n_rows) for job_id, fn, n_rows in files[scenario]] for scenario in scenarios}
+        tables[n] = (files, None if columns.get(n) is None else _required_columns(n, columns[n]))
+    data = parallel_load.load_tables(tables, scenarios, n_workers)
 
-        data['particles'].eval('true_fd = sqrt('
-            '(true_d0_vertex_x - true_dst_vertex_x)**2 + '
-            '(true_d0_vertex_y - true_dst_vertex_y)**2 + '
-            '(true_d0_vertex_z - true_dst_vertex_z)**2'
-        ')', inplace=True)
-        data['particles'].eval('D0_p = sqrt(D0_p_x**2 + D0_p_y**2 + D0_p_z**2)', inplace=True)
-        data['particles'].eval(f'D0_gamma = 1/sqrt(1 + D0_p**2/{D0_mass**2})', inplace=True)
+    for n in names:
+        if cache:
+            files, n_columns = tables[n]
+            filenames = [fn for scenario in scenarios for fn, n_rows in files[scenario]]
+            n_rows = [n_rows for scenario in scenarios for fn, n_rows in files[scenario]]
+            _add_cached_derived_columns(n, data[n], filenames, n_rows, DERIVED_CACHE)
+        else:
+            _add_derived_columns(n, data[n])
 
-        data['particles'].eval('D0_true_p = sqrt(D0_true_p_x**2 + D0_true_p_y**2 + D0_true_p_z**2)', inplace=True)
-        data['particles'].eval(f'D0_true_gamma = 1/sqrt(1 + D0_true_p**2/{D0_mass**2})', inplace=True)
+    if 'residuals' in names:
+        # The rows of each scenario are contiguous so they can be split without copying
+        residuals = data['residuals']
+        bounds = np.searchsorted(residuals['scenario'].cat.codes.to_numpy(), np.arange(len(scenarios)+1))
+        data['residuals'] = {scenario: residuals.iloc[start:stop] for scenario, start, stop in zip(scenarios, bounds[:-1], bounds[1:])}
 
     return tuple([data[k] for k in names])
 
+def iter_chunks(df_name, scenarios=None, columns=None, chunk_size=1000000, fast=False, max_jobs=None):
+    """Iterate over a table without loading it all into memory
+
+    Yields ``(scenario, job_id, df)`` where ``df`` has at most ``chunk_size``
+    rows and already has the derived columns. <columns> is a list of columns
+    for this table and <fast> and <max_jobs> select the jobs, as for ``load``.
+    """
+    output_catalog = catalog.load()
+    if scenarios is None:
+        scenarios = output_catalog.scenarios('particles')
+    if columns is not None:
+        columns = _required_columns(df_name, columns)
+
+    files = _plan_files(output_catalog, df_name, scenarios, fast, max_jobs)
+    for scenario in scenarios:
+        for job_id, fn, n_rows in files[scenario]:
+            for df in table_io.iter_table(fn, columns=columns, chunk_size=chunk_size):
+                df['scenario'] = table_schema.scenario_column(scenario, scenarios, len(df))
+                _add_derived_columns(df_name, df)
+                yield scenario, job_id, df
+
+class Reducer:
+    """Base class for aggregations which can be folded over chunks of a table
+
+    <column> is either a column name or an expression for ``DataFrame.eval``
+    and <query> optionally selects the rows to use.
+    """
+    def __init__(self, column=None, query=None):
+        self.column = column
+        self.query = query
+
+    def _select(self, df):
+        return df if self.query is None else df.query(self.query)
+
+    def _values(self, df):
+        df = self._select(df)
+        values = df[self.column] if self.column in df else df.eval(self.column)
+        values = np.asarray(values, dtype=np.float64)
+        return values[np.isfinite(values)]
+
+    def fill(self, df):
+        raise NotImplementedError()
+
+    def merge(self, other):
+        raise NotImplementedError()
+
+class Count(Reducer):
+    def __init__(self, query=None):
+        super().__init__(query=query)
+        self.result = 0
+
+    def fill(self, df):
+        self.result += len(self._select(df))
+
+    def merge(self, other):
+        self.result += other.result
+
+class Sum(Reducer):
+    def __init__(self, column, query=None):
+        super().__init__(column, query)
+        self.result = 0.
+
+    def fill(self, df):
+        self.result += self._values(df).sum()
+
+    def merge(self, other):
+        self.result += other.result
+
+class MinMax(Reducer):
+    def __init__(self, column, query=None):
+        super().__init__(column, query)
+        self.result = (np.inf, -np.inf)
+
+    def _update(self, low, high):
+        self.result = (min(self.result[0], low), max(self.result[1], high))
+
+    def fill(self, df):
+        values = self._values(df)
+        if len(values):
+            self._update(values.min(), values.max())
+
+    def merge(self, other):
+        self._update(*other.result)
+
+class Histogram(histograms.Histogram):
+    """1D ``histograms.Histogram`` of a column, ``result`` is ``(counts, edges)``
+
+    Like the reducers, <column> is a column name or an expression and <query>
+    optionally selects the rows. Values outside the bins, including NaN, aren't
+    counted.
+    """
+    def __init__(self, column, bins, range=None, query=None):
+        super().__init__([histograms.Axis(column, bins, range)], query=query)
+
+def reduce_chunks(chunks, reducers, by_scenario=True):
+    """Fold a dictionary of reducers over the chunks from ``iter_chunks``
+
+    A copy of <reducers> is filled for each scenario unless <by_scenario> is
+    False, in which case the returned dictionary has a single key of None.
+    """
+    results = {}
+    for scenario, job_id, df in chunks:
+        key = scenario if by_scenario else None
+        if key not in results:
+            results[key] = deepcopy(reducers)
+        for reducer in results[key].values():
+            reducer.fill(df)
+    return results
+
+_event_indices = {}
+
+def _event_index(scenario):
+    """Map ``(run_number, event_number)`` to the job ID and row ranges of each event in a scenario"""
+    if scenario not in _event_indices:
+        lookup = {}
+        output_catalog = catalog.load()
+        for job_id in sorted(output_catalog.entries.get(scenario, {})):
+            fn = table_io.index_filename(f'output/scenarios/{scenario}', job_id)
+            if not os.path.isfile(fn):
+                continue
+            index = table_io.EventIndex.load(fn)
+            for i, event in enumerate(zip(index.run_numbers, index.event_numbers)):
+                lookup[event] = (job_id, {n: index.ranges[n][i] for n in index.ranges})
+        _event_indices[scenario] = lookup
+    return _event_indices[scenario]
+
+def load_events(scenario, events, names=['clusters', 'tracks', 'residuals', 'particles'], columns=None):
+    """Load the rows of some events using the event index written by read_xdst.py
+
+    <events> is either a single ``(run_number, event_number)`` pair or a list
+    of them. Each file is only read once for all of the events in it, only
+    the row groups containing the events are read from parquet files while
+    msgpack files have to be read in full.
+    """
+    if isinstance(events, tuple):
+        events = [events]
+    if columns is None:
+        columns = {}
+
+    # Group the events by job so each file is only read once
+    index = _event_index(scenario)
+    events_by_job = OrderedDict()
+    for i, event in enumerate(events):
+        try:
+            job_id, ranges = index[event]
+        except KeyError:
+            raise ValueError(f'Event {event} not found in the index of {scenario}')
+        events_by_job.setdefault(job_id, []).append((i, ranges))
+
+    dfs = {n: [None]*len(events) for n in names}
+    for job_id, job_events in events_by_job.items():
+        for n in names:
+            if n not in job_events[0][1]:
+                raise ValueError(f'The {n} table of job {job_id} of {scenario} was not extracted')
+            fn = table_io.find_table(f'output/scenarios/{scenario}', n, job_id)
+            n_columns = None if columns.get(n) is None else _required_columns(n, columns[n])
+            job_dfs = table_io.read_ranges(fn, [ranges[n] for i, ranges in job_events], columns=n_columns)
+            for (i, ranges), df in zip(job_events, job_dfs):
+                dfs[n][i] = df
+
+    data = []
+    for n in names:
+        df = pd.concat(dfs[n], ignore_index=True)
+        df['scenario'] = table_schema.scenario_column(scenario, [scenario], len(df))
+        _add_derived_columns(n, df)
+        data.append(df)
+    return tuple(data)
+
 def format_label(s):
     if s == 'Original_DB' or s == 'Nominal':
         return 'Nominal'
@@ -0,0 +1,79 @@
+# [SublimeLinter flake8-max-line-length:150]
+"""Timers and counters for the stages of read_xdst.py"""
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+import json
+import os
+from timeit import default_timer
+
+
+class StageTimer(object):
+    """Accumulates the time spent in each stage of a loop
+
+    Calling ``lap(stage)`` adds the time since the previous lap to <stage> so
+    the loop can be instrumented without changing its structure, e.g.::
+
+        timer.lap()  # Start timing
+        read_event()
+        timer.lap('event read')
+        fit_tracks()
+        timer.lap('residual fits')
+    """
+    def __init__(self):
+        self.times = OrderedDict()
+        self.calls = OrderedDict()
+        self.counters = OrderedDict()
+        self._start = default_timer()
+        self._last = self._start
+
+    def lap(self, stage=None):
+        now = default_timer()
+        if stage is not None:
+            self.times[stage] = self.times.get(stage, 0) + now - self._last
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+        self._last = now
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    @property
+    def elapsed(self):
+        return default_timer() - self._start
+
+    def to_dict(self):
+        elapsed = self.elapsed
+        n_events = self.counters.get('events', 0)
+        return OrderedDict([
+            ('elapsed', elapsed),
+            ('events_per_second', n_events / elapsed if elapsed else 0),
+            ('stages', OrderedDict(
+                (stage, OrderedDict([('time', time), ('calls', self.calls[stage])]))
+                for stage, time in self.times.items()
+            )),
+            ('counters', self.counters),
+        ])
+
+    def report(self):
+        """Return the breakdown of the time spent in each stage as a string"""
+        summary = self.to_dict()
+        lines = ['{:<20} {:>10} {:>7} {:>10}'.format('Stage', 'Time (s)', '%', 'Calls')]
+        for stage, values in summary['stages'].items():
+            lines.append('{:<20} {:>10.2f} {:>7.1f} {:>10}'.format(
+                stage, values['time'], 100 * values['time'] / summary['elapsed'], values['calls']
+            ))
+        other = summary['elapsed'] - sum(self.times.values())
+        lines.append('{:<20} {:>10.2f} {:>7.1f}'.format('other', other, 100 * other / summary['elapsed']))
+        lines.append('')
+        for name, n in self.counters.items():
+            lines.append('{:<20} {:>10}'.format(name, n))
+        lines.append('Processed {} events in {:.1f} s ({:.2f} events/s)'.format(
+            self.counters.get('events', 0), summary['elapsed'], summary['events_per_second']
+        ))
+        return '\n'.join(lines)
+
+    def save(self, fn):
+        with open(fn + '.tmp', 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.rename(fn + '.tmp', fn)
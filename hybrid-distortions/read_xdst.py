@@ -4,14 +4,15 @@ from __future__ import print_function
 
 import argparse
 from glob import glob
-from os.path import join, basename, isfile
+from os.path import join, basename, isdir, isfile
 import os
+import shutil
+import subprocess
 import sys
 
-# Lets get an acceptable version of pandas
+# Lets get an acceptable version of pandas, which is imported by table_io
 # Create using 'pip install --target my_pandas pandas'
 sys.path.insert(0, os.path.abspath('./my_pandas/'))  # NOQA
-import pandas as pd
 from tqdm import tqdm
 
 from Configurables import CondDB
@@ -23,12 +24,21 @@ from GaudiConf import IOHelper
 from LHCbConfig import ApplicationMgr, lhcbApp
 from LHCbMath import XYZPoint
 
+import catalog
+from profiling import StageTimer
+import table_io
+import table_schema
 import track_tools
 from track_tools import Track
+from true_clusters import TrueClusterIndex
+
+
+def input_files(job_name, job_id):
+    return glob(join('output/scenarios', job_name, 'hists', str(job_id), 'Brunel.xdst'))
 
 
 def add_data(job_name, job_id):
-    IOHelper('ROOT').inputFiles(glob(join('output/scenarios', job_name, 'hists', str(job_id), 'Brunel.xdst')))
+    IOHelper('ROOT').inputFiles(input_files(job_name, job_id))
 
     CondDB().Upgrade = True
     if job_name == 'Original_DB':
@@ -64,186 +74,325 @@ def configure():
     appConf.TopAlg += [PreLoadPions, PreLoadKaons]
 
 
-def read_tracks_and_clusters(scenario, job_id, n_events):
-    add_data(scenario, job_id)
-    configure()
-    appMgr, evt = track_tools.initialise()
-
-    true_clusters_fn = 'output/scenarios/Original_DB/clusters_'+str(job_id)+'.msg'
-    if isfile(true_clusters_fn) and scenario != 'Original_DB':
-        true_clusters = pd.read_msgpack(true_clusters_fn)
-        if isinstance(true_clusters, list):
-            true_clusters = pd.concat(true_clusters)
-            true_clusters['run_number'] = pd.to_numeric(true_clusters['run_number'], downcast='unsigned')
-            true_clusters['event_number'] = pd.to_numeric(true_clusters['event_number'], downcast='unsigned')
-            true_clusters.set_index(['run_number', 'event_number', 'channel_id'], inplace=True)
-            true_clusters.sortlevel(inplace=True)
-    else:
-        true_clusters = None
+def shard_events(n_events, shard):
+    """Return the first and last (exclusive) event numbers of a shard"""
+    i, n_shards = shard
+    return i * n_events // n_shards, (i + 1) * n_events // n_shards
+
+
+def shard_dir(scenario, job_id):
+    return join('output/scenarios', scenario, 'shards_'+str(job_id))
+
 
-    clusters = []
-    tracks = []
-    residuals = []
-    particles = []
+def profile_filename(scenario, job_id, shard=None):
+    """The JSON file the time spent in each stage is saved to, next to the output tables"""
+    if shard is None:
+        return join('output/scenarios', scenario, 'profile_{}.json'.format(job_id))
+    return join('output/scenarios', scenario, 'profile_{}_shard{}.json'.format(job_id, shard[0]))
 
-    write_msgpack.do_append = False
 
+def read_tracks_and_clusters(scenario, job_ids, n_events, output_format='msgpack', flush_events=10, flush_bytes=None, resume=False,
+                             shard=None, ip_mode='batch', poca_mode='trajpoca', poca_check_every=10, profile=False, profile_json=False,
+                             tables=table_schema.TABLE_NAMES, truth_residuals=True, fake_ut=True):
+    """Extract the tables of one or more jobs from their xdst files
+
+    <job_ids> is a job ID or a list of job IDs of <scenario>. The jobs are read
+    one after the other by the same application so it is only initialised
+    once. Only the stages which are needed for <tables> are run. If
+    <truth_residuals> is False the residuals with respect to the Original_DB
+    clusters are left empty and if <fake_ut> is False the fake UT clusters
+    aren't added.
+    """
+    if not isinstance(job_ids, (list, tuple)):
+        job_ids = [job_ids]
+
+    for i, job_id in enumerate(job_ids):
+        if shard is None:
+            first_event, last_event = 0, n_events
+            out_dir, out_name = join('output/scenarios', scenario), job_id
+        else:
+            # Shards write to a separate directory and are merged by merge_shards
+            first_event, last_event = shard_events(n_events, shard)
+            out_dir, out_name = shard_dir(scenario, job_id), shard[0]
+            try:
+                os.makedirs(out_dir)
+            except OSError:
+                if not isdir(out_dir):
+                    raise
+
+        # The maximum differences of the cross-checks are printed for each job
+        track_tools.batch_ip.max_deviation = 0
+        track_tools.line_poca.max_deviation = 0
+
+        # The output, checkpoint and truth of each job are separate
+        writer = table_io.EventWriter(
+            table_io.get_writer(output_format, out_dir, out_name, tables),
+            flush_events=flush_events, flush_bytes=flush_bytes, resume=resume, event_range=(first_event, last_event)
+        )
+        if writer.n_committed:
+            print('Resuming job', job_id, 'after', writer.n_committed, 'events')
+        skip_events = first_event + writer.n_committed
+
+        if i == 0:
+            if skip_events:
+                lhcbApp.SkipEvents = skip_events
+            add_data(scenario, job_id)
+            configure()
+            track_tools.initialise(skip_events=skip_events)
+        else:
+            # Reuse the application and only change the input files
+            track_tools.open_input([IOHelper('ROOT').dressFile(fn, 'I') for fn in input_files(scenario, job_id)], skip_events)
+
+        true_clusters_fn = table_io.find_table('output/scenarios/Original_DB', 'clusters', job_id)
+        if true_clusters_fn is not None and scenario != 'Original_DB' and 'residuals' in tables and truth_residuals:
+            true_clusters = TrueClusterIndex.from_file(true_clusters_fn)
+        else:
+            true_clusters = None
+
+        timer = extract_events(writer, last_event, true_clusters, tables, fake_ut, ip_mode, poca_mode, poca_check_every)
+        if shard is None:
+            catalog.update_job(scenario, job_id, tables)
+
+        print('Maximum number of chunks waiting to be written was', writer.max_queue_depth)
+        if ip_mode == 'check':
+            print('Maximum difference between the batched and per-track IPs was', track_tools.batch_ip.max_deviation)
+        if poca_mode == 'check':
+            print('Maximum difference between the straight line and TrajPoca residuals was', track_tools.line_poca.max_deviation)
+        if profile:
+            print(timer.report())
+        if profile_json:
+            timer.save(profile_filename(scenario, job_id, shard))
+
+
+def extract_events(writer, last_event, true_clusters=None, tables=table_schema.TABLE_NAMES, fake_ut=True, ip_mode='batch',
+                   poca_mode='trajpoca', poca_check_every=10):
+    """Add the rows of each event to <writer> until <last_event> is reached
+
+    <writer> is closed at the end and the ``StageTimer`` of the events is returned.
+    """
+    evt = track_tools.evt
+
+    # The tracks are needed for every table apart from the clusters and PVs
+    read_tracks = bool(set(tables) - {'clusters', 'pvs'}) or ('clusters' in tables and fake_ut)
+
+    timer = StageTimer()
     # pbar = tqdm(total=100)
     while True:
         # pbar.update(1)
+        timer.lap()
         n_event = track_tools.run()
 
         # Look at the header
         header = evt['/Event/Rec/Header']
-        if not header or n_event >= n_events:
+        if not header or n_event >= last_event:
             break
         run_number = header.runNumber()
         event_number = header.evtNumber()
+        timer.lap('event read')
+        timer.count('events')
+
+        clusters = []
+        tracks = []
+        residuals = []
+        particles = []
+        states = []
+        pvs = []
 
         # Store information about the clusters
-        for channel_id, cluster in track_tools.get_clusters().items():
-            clusters.append([run_number, event_number, channel_id, cluster.x, cluster.y, cluster.z])
+        if 'clusters' in tables:
+            for channel_id, x, y, z in track_tools.get_clusters().iter_rows():
+                clusters.append([run_number, event_number, channel_id, x, y, z])
+            timer.count('clusters', len(clusters))
 
-        # Make a dataframe of just this event's clusters (for speed)
+        # Get the true positions of just this event's clusters (for speed)
         if true_clusters is None:
             true_clusters_for_event = None
         else:
-            # true_clusters_for_event = true_clusters.query(
-            #     '(run_number == {run_number}) & (event_number == {event_number})'
-            #     .format(run_number=run_number, event_number=event_number)
-            # )
-            true_clusters_for_event = true_clusters.loc[run_number, event_number]
-
-        # Store information about the tracks
-        for track_number, track in enumerate(map(Track, evt['Rec/Track/Best'])):
-            try:
-                mc_particle = track.mc_particle
-            except ValueError:
-                mc_particle_px, mc_particle_py, mc_particle_pz = None, None, None
-            else:
-                mc_particle_px = mc_particle.px
-                mc_particle_py = mc_particle.py
-                mc_particle_pz = mc_particle.pz
+            true_clusters_for_event = true_clusters.for_event(run_number, event_number)
+        timer.lap('clusters')
+
+        # Store the PVs so the IPs can be recomputed offline
+        if 'pvs' in tables:
+            for pv_number, (pv, (x, y, z)) in enumerate(zip(track_tools.get_pvs(), track_tools.get_pv_positions().tolist())):
+                covariance = pv.covMatrix()
+                pvs.append([run_number, event_number, pv_number, x, y, z] + [
+                    covariance(i, j) for i, j in table_schema.PV_COVARIANCE_ELEMENTS
+                ])
+            timer.lap('PVs')
 
-            IP3D, IPx, IPy = track.ip
+        if 'tracks' in tables or 'particles' in tables:
+            track_tools.get_mc_particles()
+            timer.lap('truth matching')
 
-            tracks.append([
-                run_number, event_number, track_number, track.key, track.track_type,
-                track.rx, track.ry, track.px, track.py, track.pz,
-                mc_particle_px, mc_particle_py, mc_particle_pz,
-                IP3D, IPx, IPy
-            ])
+        if not read_tracks:
+            event_tracks = []
+        else:
+            event_tracks = list(map(Track, evt['Rec/Track/Best']))
+            timer.count('tracks', len(event_tracks))
+            timer.lap('tracks')
+        if 'tracks' in tables and ip_mode != 'track':
+            track_ips = track_tools.batch_ip(event_tracks, cross_check=ip_mode == 'check')
+            timer.lap('IP')
+        for track_number, track in enumerate(event_tracks):
+            # Store information about the tracks
+            if 'tracks' in tables:
+                try:
+                    mc_particle = track.mc_particle
+                except ValueError:
+                    mc_particle_px, mc_particle_py, mc_particle_pz = None, None, None
+                else:
+                    mc_particle_px = mc_particle.px
+                    mc_particle_py = mc_particle.py
+                    mc_particle_pz = mc_particle.pz
+                timer.lap('truth matching')
+
+                if ip_mode == 'batch':
+                    IP3D, IPx, IPy = track_ips[track_number]
+                else:
+                    IP3D, IPx, IPy = track.ip
+                timer.lap('IP')
+
+                tracks.append([
+                    run_number, event_number, track_number, track.key, track.track_type,
+                    track.rx, track.ry, track.px, track.py, track.pz,
+                    mc_particle_px, mc_particle_py, mc_particle_pz,
+                    IP3D, IPx, IPy
+                ])
+
+            # Store the reference state so residuals can be recomputed offline
+            if 'states' in tables:
+                state = track.state
+                covariance = state.covariance()
+                states.append([
+                    run_number, event_number, track_number, track.track_type, track.state_location,
+                    state.x(), state.y(), state.z(), state.tx(), state.ty(), state.qOverP(),
+                ] + [covariance(i, j) for i, j in table_schema.COVARIANCE_ELEMENTS])
 
             # Insert a fake UT cluster
-            fake_ut_channel_id = -1 * (int(run_number*1e10) + int(event_number*1e3) + int(track_number))
-            fake_position = track.fit_to_point(XYZPoint(0, 0, 2500), minimise=False)
-            clusters.append([run_number, event_number, fake_ut_channel_id, fake_position.x(), fake_position.y(), fake_position.z()])
+            if 'clusters' in tables and fake_ut:
+                fake_ut_channel_id = -1 * (int(run_number*1e10) + int(event_number*1e3) + int(track_number))
+                fake_position = track.fit_to_point(XYZPoint(0, 0, 2500), minimise=False)
+                clusters.append([run_number, event_number, fake_ut_channel_id, fake_position.x(), fake_position.y(), fake_position.z()])
+            timer.lap('tracks')
+
+            if 'residuals' not in tables:
+                continue
 
             # Store information about the associated clusters
-            for hit in track.vp_hits:
+            vp_hits = track.vp_hits
+            channel_ids = [hit.cluster.channel_id for hit in vp_hits]
+            point_sets = [track_tools.get_clusters().positions(channel_ids)]
+            if true_clusters_for_event is not None:
+                point_sets.append(true_clusters_for_event.positions(channel_ids))
+
+            # Calculate the residuals for this geometry and the true geometry,
+            # the track is only propagated once to each cluster's z
+            if poca_mode == 'check' and track_number % poca_check_every != 0:
+                fits = track.fit_to_points(point_sets, method='line')
+            else:
+                fits = track.fit_to_points(point_sets, method=poca_mode)
+            intercepts, hit_residuals = fits[0]
+            for i, hit in enumerate(vp_hits):
                 hit_data = [
-                    run_number, event_number, track_number, hit.cluster.channel_id,
+                    run_number, event_number, track_number, channel_ids[i],
                     hit.module, hit.sensor, hit.chip, hit.row, hit.col, hit.scol
                 ]
-
-                # Calculate the residual for this geometry
-                intercept, residual = track.fit_to_point(hit.cluster.position)
-                hit_data.extend([intercept.x(), intercept.y(), intercept.z()])
-                hit_data.extend([residual.x(), residual.y(), residual.z()])
-
-                # Calculate the residual for the true geometry
+                hit_data.extend(intercepts[i].tolist())
+                hit_data.extend(hit_residuals[i].tolist())
                 if true_clusters_for_event is None:
                     hit_data.extend([None]*6)
                 else:
-                    # true_cluster = true_clusters_for_event[
-                    #     (true_clusters_for_event.channel_id == hit.cluster.channel_id)
-                    # ]
-                    # true_cluster = true_clusters_for_event.loc[hit.cluster.channel_id]
-                    # assert len(true_cluster) == 1
-                    # true_cluster = true_cluster.iloc[0]
-                    true_point = XYZPoint(
-                        true_clusters_for_event.at[float(hit.cluster.channel_id), 'x'],
-                        true_clusters_for_event.at[float(hit.cluster.channel_id), 'y'],
-                        true_clusters_for_event.at[float(hit.cluster.channel_id), 'z']
-                    )
-                    true_intercept, true_residual = track.fit_to_point(true_point)
-                    hit_data.extend([true_intercept.x(), true_intercept.y(), true_intercept.z()])
-                    hit_data.extend([true_residual.x(), true_residual.y(), true_residual.z()])
-
+                    true_intercepts, true_residuals = fits[1]
+                    hit_data.extend(true_intercepts[i].tolist())
+                    hit_data.extend(true_residuals[i].tolist())
                 residuals.append(hit_data)
+            timer.count('hits', len(vp_hits))
+            timer.lap('residual fits')
 
         # Add infromation about any truth matched particles we can find:
-        for kp_track, km_track, pi_track in track_tools.get_dstars():
-            try:
-                D0, pv, pv_ipchi2, d0_vertex, true_d0_vertex, true_dst_vertex, true, fitted, kp, km, pi = track_tools.fit_vertex(kp_track, km_track, pi_track)
-            except ValueError:
-                pass
-            else:
-                D0_mc = kp_track.mc_particle.mother
-                kp_mc = kp_track.mc_particle
-                km_mc = km_track.mc_particle
-                pi_mc = pi_track.mc_particle
-                particles.append([
-                    run_number, event_number, kp_track.key, km_track.key, pi_track.key, d0_vertex.chi2(), d0_vertex.chi2PerDoF(),
-                    D0.momentum().x(), D0.momentum().y(), D0.momentum().z(), D0_mc.px, D0_mc.py, D0_mc.pz,
-                    d0_vertex.position().x(), d0_vertex.position().y(), d0_vertex.position().z(),
-                    true_d0_vertex.x(), true_d0_vertex.y(), true_d0_vertex.z(),
-                    pv.position().x(), pv.position().y(), pv.position().z(), pv_ipchi2,
-                    true_dst_vertex.x(), true_dst_vertex.y(), true_dst_vertex.z(),
-                    kp_track.px, kp_track.py, kp_track.pz, kp_mc.px, kp_mc.py, kp_mc.pz,
-                    km_track.px, km_track.py, km_track.pz, km_mc.px, km_mc.py, km_mc.pz,
-                    pi_track.px, pi_track.py, pi_track.pz, pi_mc.px, pi_mc.py, pi_mc.pz,
-                ])
+        if 'particles' not in tables:
+            candidates = []
+        else:
+            candidates = track_tools.fit_vertices(track_tools.get_dstars(event_tracks))
+        for (kp_track, km_track, pi_track), fit in candidates:
+            D0, pv, pv_ipchi2, d0_vertex, true_d0_vertex, true_dst_vertex, true, fitted, kp, km, pi = fit
+            D0_mc = kp_track.mc_particle.mother
+            kp_mc = kp_track.mc_particle
+            km_mc = km_track.mc_particle
+            pi_mc = pi_track.mc_particle
+            particles.append([
+                run_number, event_number, kp_track.key, km_track.key, pi_track.key, d0_vertex.chi2(), d0_vertex.chi2PerDoF(),
+                D0.momentum().x(), D0.momentum().y(), D0.momentum().z(), D0_mc.px, D0_mc.py, D0_mc.pz,
+                d0_vertex.position().x(), d0_vertex.position().y(), d0_vertex.position().z(),
+                true_d0_vertex.x(), true_d0_vertex.y(), true_d0_vertex.z(),
+                pv.position().x(), pv.position().y(), pv.position().z(), pv_ipchi2,
+                true_dst_vertex.x(), true_dst_vertex.y(), true_dst_vertex.z(),
+                kp_track.px, kp_track.py, kp_track.pz, kp_mc.px, kp_mc.py, kp_mc.pz,
+                km_track.px, km_track.py, km_track.pz, km_mc.px, km_mc.py, km_mc.pz,
+                pi_track.px, pi_track.py, pi_track.pz, pi_mc.px, pi_mc.py, pi_mc.pz,
+            ])
+        timer.count('particles', len(particles))
+        timer.lap('vertex fits')
 
-        # Store output every 10 events
-        if n_event % 10:
-            write_msgpack(scenario, job_id, clusters, tracks, particles, residuals)
-            # Clear the existing arrays
-            clusters = []
-            tracks = []
-            residuals = []
-            particles = []
+        # The output is written in chunks by a background thread
+        writer.add_event(run_number, event_number, {
+            'clusters': clusters, 'tracks': tracks, 'particles': particles, 'residuals': residuals, 'states': states,
+            'pvs': pvs,
+        })
+        timer.lap('writes')
 
     # pbar.close()
 
-    write_msgpack(scenario, job_id, clusters, tracks, particles, residuals)
+    timer.lap()
+    writer.close()
+    timer.lap('writes')
+    return timer
 
 
-def write_msgpack(scenario, job_id, clusters, tracks, particles, residuals):
-    out_dir = join('output/scenarios', scenario)
-
-    clusters = pd.DataFrame(clusters, columns=['run_number', 'event_number', 'channel_id', 'x', 'y', 'z'])
-    clusters.to_msgpack(join(out_dir, 'clusters_'+str(job_id)+'.msg'), append=write_msgpack.do_append)
-
-    tracks = pd.DataFrame(tracks, columns=[
-        'run_number', 'event_number', 'track_number', 'track_key', 'track_type',
-        'tx', 'ty', 'px', 'py', 'pz', 'true_px', 'true_py', 'true_pz', 'IP3D', 'IPx', 'IPy'
-    ])
-    tracks.to_msgpack(join(out_dir, 'tracks_'+str(job_id)+'.msg'), append=write_msgpack.do_append)
-
-    # TODO Prompt and charge information
-    particles = pd.DataFrame(particles, columns=[
-        'run_number', 'event_number', 'kp_track_key', 'km_track_key', 'pi_track_key', 'vertex_chi2', 'vertex_chi2_per_DoF',
-        'D0_p_x', 'D0_p_y', 'D0_p_z', 'D0_true_p_x', 'D0_true_p_y', 'D0_true_p_z', 'vertex_x', 'vertex_y', 'vertex_z',
-        'true_d0_vertex_x', 'true_d0_vertex_y', 'true_d0_vertex_z',
-        'pv_x', 'pv_y', 'pv_z', 'pv_ipchi2',
-        'true_dst_vertex_x', 'true_dst_vertex_y', 'true_dst_vertex_z',
-        'kp_px', 'kp_py', 'kp_pz', 'kp_true_px', 'kp_true_py', 'kp_true_pz',
-        'km_px', 'km_py', 'km_pz', 'km_true_px', 'km_true_py', 'km_true_pz',
-        'pi_px', 'pi_py', 'pi_pz', 'pi_true_px', 'pi_true_py', 'pi_true_pz',
-    ])
-    particles.to_msgpack(join(out_dir, 'particles_'+str(job_id)+'.msg'), append=write_msgpack.do_append)
-
-    residuals = pd.DataFrame(residuals, columns=[
-        'run_number', 'event_number', 'track_number', 'cluster_channel_id',
-        'module', 'sensor', 'chip', 'row', 'col', 'scol',
-        'intercept_x', 'intercept_y', 'intercept_z', 'residual_x', 'residual_y', 'residual_z',
-        'true_intercept_x', 'true_intercept_y', 'true_intercept_z', 'true_residual_x', 'true_residual_y', 'true_residual_z',
-    ])
-    residuals.to_msgpack(join(out_dir, 'residuals_'+str(job_id)+'.msg'), append=write_msgpack.do_append)
-
-    # Append after the first write
-    write_msgpack.do_append = True
+def merge_shards(scenario, job_id, n_shards, output_format='msgpack', tables=table_schema.TABLE_NAMES):
+    """Combine the output of the shards of a job into the usual output files"""
+    table_io.merge_outputs(
+        [(shard_dir(scenario, job_id), i) for i in range(n_shards)],
+        table_io.get_writer(output_format, join('output/scenarios', scenario), job_id, tables)
+    )
+    shutil.rmtree(shard_dir(scenario, job_id))
+    catalog.update_job(scenario, job_id, tables)
+
+
+def run_shards(scenario, job_id, n_events, n_shards, output_format='msgpack', resume=False, worker_args=[],
+               tables=table_schema.TABLE_NAMES):
+    """Process a job using a worker process for each shard and merge the output"""
+    workers = {}
+    for i in range(n_shards):
+        # Shards which finished in a previous attempt don't need to be rerun
+        if resume and isfile(table_io.index_filename(shard_dir(scenario, job_id), i)):
+            continue
+        workers[i] = subprocess.Popen([
+            sys.executable, os.path.abspath(__file__), scenario, '--job-id', str(job_id), '--n-events', str(n_events),
+            '--format', output_format, '--shard', '{}/{}'.format(i, n_shards), '--tables', ','.join(tables)
+        ] + (['--resume'] if resume else []) + worker_args)
+    failed = sorted(i for i, worker in workers.items() if worker.wait() != 0)
+    if failed:
+        raise RuntimeError('Shards {} of job {} failed, rerun with --resume to retry them'.format(failed, job_id))
+    merge_shards(scenario, job_id, n_shards, output_format, tables)
+
+
+def parse_shard(shard):
+    try:
+        i, n_shards = map(int, shard.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Shards should be given as i/N')
+    if not 0 <= i < n_shards:
+        raise argparse.ArgumentTypeError('Shard must be between 0 and N-1')
+    return i, n_shards
+
+
+def parse_tables(tables):
+    tables = tables.split(',')
+    unknown = set(tables) - set(table_schema.TABLE_NAMES)
+    if unknown:
+        raise argparse.ArgumentTypeError('Unknown tables: ' + ', '.join(sorted(unknown)))
+    return [table for table in table_schema.TABLE_NAMES if table in tables]
 
 
 if __name__ == '__main__':
@@ -254,8 +403,8 @@ if __name__ == '__main__':
         help='The reconstruction scenario to use'
     )
     parser.add_argument(
-        '--job-id', type=int, required=True,
-        help='The reconstruction scenario to use'
+        '--job-id', type=int, nargs='+', required=True,
+        help='The jobs to read, several jobs are read one after the other without reinitialising'
     )
 
     parser.add_argument(
@@ -263,5 +412,87 @@ if __name__ == '__main__':
         help='The reconstruction scenario to use'
     )
 
+    parser.add_argument(
+        '--format', choices=sorted(table_io.WRITERS), default='msgpack',
+        help='The file format to write the output tables in'
+    )
+
+    parser.add_argument(
+        '--flush-events', type=int, default=10,
+        help='Write the output after this many events'
+    )
+    parser.add_argument(
+        '--flush-mb', type=float,
+        help='Also write the output once this many MB of rows are buffered'
+    )
+
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Continue from the last checkpoint of a previous run of this job'
+    )
+
+    parser.add_argument(
+        '--tables', type=parse_tables, default=table_schema.TABLE_NAMES,
+        help='Comma separated list of the tables to extract, the stages which are only needed by other tables are skipped'
+    )
+    parser.add_argument(
+        '--no-truth-residuals', dest='truth_residuals', action='store_false',
+        help="Don't calculate the residuals with respect to the Original_DB clusters"
+    )
+    parser.add_argument(
+        '--no-fake-ut', dest='fake_ut', action='store_false',
+        help="Don't add the fake UT clusters to the clusters table"
+    )
+
+    parser.add_argument(
+        '--ip-mode', choices=['batch', 'track', 'check'], default='batch',
+        help='Calculate IPs for all tracks at once, per track with the extrapolator or per track while checking the batched IPs'
+    )
+    parser.add_argument(
+        '--poca-mode', choices=['trajpoca', 'line', 'check'], default='trajpoca',
+        help='Calculate residuals with TrajPoca, in closed form for a straight line or in closed form while checking a sample with TrajPoca'
+    )
+    parser.add_argument(
+        '--poca-check-every', type=int, default=10,
+        help='With --poca-mode check, compare every N-th track with TrajPoca'
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Print the time spent in each stage and the number of events per second at the end'
+    )
+    parser.add_argument(
+        '--profile-json', action='store_true',
+        help='Save the time spent in each stage as profile_<job_id>.json next to the output tables'
+    )
+    parser.add_argument(
+        '--shard', type=parse_shard,
+        help='Only process the i-th of N equal event ranges of the job, given as i/N'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Split the job into this many shards which are processed in parallel and then merged'
+    )
+
     args = parser.parse_args()
-    read_tracks_and_clusters(args.scenario, args.job_id, args.n_events)
+    flush_bytes = None if args.flush_mb is None else int(args.flush_mb * 1024**2)
+    if args.workers > 1:
+        worker_args = [
+            '--flush-events', str(args.flush_events), '--ip-mode', args.ip_mode,
+            '--poca-mode', args.poca_mode, '--poca-check-every', str(args.poca_check_every),
+        ]
+        worker_args += ['--no-truth-residuals'] if not args.truth_residuals else []
+        worker_args += ['--no-fake-ut'] if not args.fake_ut else []
+        worker_args += ['--profile'] if args.profile else []
+        worker_args += ['--profile-json'] if args.profile_json else []
+        if flush_bytes is not None:
+            worker_args += ['--flush-mb', str(args.flush_mb)]
+        for job_id in args.job_id:
+            run_shards(args.scenario, job_id, args.n_events, args.workers, args.format, args.resume, worker_args, args.tables)
+    else:
+        read_tracks_and_clusters(
+            args.scenario, args.job_id, args.n_events, args.format,
+            flush_events=args.flush_events, flush_bytes=flush_bytes, resume=args.resume, shard=args.shard,
+            ip_mode=args.ip_mode, poca_mode=args.poca_mode, poca_check_every=args.poca_check_every,
+            profile=args.profile, profile_json=args.profile_json,
+            tables=args.tables, truth_residuals=args.truth_residuals, fake_ut=args.fake_ut
+        )
@@ -0,0 +1,576 @@
+# [SublimeLinter flake8-max-line-length:150]
+"""Reading and writing of the tables produced by read_xdst.py
+
+Each job produces one file per table in ``output/scenarios/{scenario}``. The
+format is chosen by name from ``WRITERS`` so the same extraction loop can
+produce either the legacy msgpack files or columnar parquet files.
+"""
+from __future__ import division
+from __future__ import print_function
+
+from bisect import bisect_right
+from os.path import basename, join, isdir, isfile
+import json
+import os
+import shutil
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    # Python 2
+    from Queue import Queue
+
+import numpy as np
+import pandas as pd
+
+import table_schema
+from table_schema import TABLE_NAMES
+
+
+class EventIndex(object):
+    """Row ranges of each event in the tables of a single job
+
+    The rows of an event are contiguous in every table so an event can be
+    read without scanning the whole file. Only <tables> (by default all of
+    them) are included.
+    """
+    def __init__(self, tables=TABLE_NAMES):
+        self.run_numbers = []
+        self.event_numbers = []
+        self.ranges = {table: [] for table in tables}
+        self._lookup = None
+
+    @property
+    def tables(self):
+        return [table for table in TABLE_NAMES if table in self.ranges]
+
+    def __len__(self):
+        return len(self.event_numbers)
+
+    def add(self, run_number, event_number, n_rows):
+        """Add an event with ``n_rows[table]`` rows in each table after the previous event"""
+        self.run_numbers.append(run_number)
+        self.event_numbers.append(event_number)
+        for table in self.ranges:
+            start = self.ranges[table][-1][1] if self.ranges[table] else 0
+            self.ranges[table].append((start, start + n_rows[table]))
+        self._lookup = None
+
+    def lookup(self, run_number, event_number):
+        """Return a dictionary of table name to ``(start, stop)`` for an event"""
+        if self._lookup is None:
+            self._lookup = {
+                (run, event): i for i, (run, event) in enumerate(zip(self.run_numbers, self.event_numbers))
+            }
+        i = self._lookup[(run_number, event_number)]
+        return {table: self.ranges[table][i] for table in self.ranges}
+
+    def extend(self, other):
+        """Add the events of another index, whose rows follow the rows of this index"""
+        for i, (run_number, event_number) in enumerate(zip(other.run_numbers, other.event_numbers)):
+            self.add(run_number, event_number, {
+                table: other.ranges[table][i][1] - other.ranges[table][i][0] for table in self.ranges
+            })
+
+    def to_dict(self, n_events=None):
+        """Convert the first <n_events> events to a JSON serialisable dictionary"""
+        n_events = len(self) if n_events is None else n_events
+        data = {
+            'run_number': self.run_numbers[:n_events],
+            'event_number': self.event_numbers[:n_events],
+        }
+        for table in self.ranges:
+            data[table] = [list(r) for r in self.ranges[table][:n_events]]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls([table for table in TABLE_NAMES if table in data])
+        index.run_numbers = list(data['run_number'])
+        index.event_numbers = list(data['event_number'])
+        for table in index.ranges:
+            index.ranges[table] = [tuple(r) for r in data[table]]
+        return index
+
+    def save(self, fn):
+        arrays = {
+            'run_number': np.array(self.run_numbers, dtype=np.uint32),
+            'event_number': np.array(self.event_numbers, dtype=np.uint64),
+        }
+        for table in self.ranges:
+            arrays[table] = np.array(self.ranges[table], dtype=np.int64).reshape(-1, 2)
+        # Write to a file object so numpy doesn't append ".npz"
+        with open(fn, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as arrays:
+            index = cls([table for table in TABLE_NAMES if table in arrays.files])
+            index.run_numbers = arrays['run_number'].tolist()
+            index.event_numbers = arrays['event_number'].tolist()
+            for table in index.ranges:
+                index.ranges[table] = [tuple(r) for r in arrays[table].tolist()]
+        return index
+
+    def update(self, other):
+        """Add the ranges of the tables of <other> which aren't in this index
+
+        Used when the tables of a job are written separately, the events of
+        both indices must be the same.
+        """
+        if (self.run_numbers, self.event_numbers) != (other.run_numbers, other.event_numbers):
+            raise ValueError('The indices contain different events')
+        for table in other.ranges:
+            self.ranges.setdefault(table, other.ranges[table])
+
+
+class TableWriter(object):
+    """Base class for writing the tables of a single job
+
+    Output is written to temporary files which are moved into place by
+    ``close`` so incomplete files are never left with the final names. The
+    amount written to each table is given by ``positions`` and
+    ``truncate`` can be used to discard anything written after a position
+    when resuming a job. Only <tables> (by default all of them) are written.
+    """
+    extension = None
+
+    def __init__(self, out_dir, job_id, tables=TABLE_NAMES):
+        self.out_dir = out_dir
+        self.job_id = job_id
+        self.tables = [table for table in TABLE_NAMES if table in tables]
+
+    def filename(self, table):
+        return join(self.out_dir, '{}_{}.{}'.format(table, self.job_id, self.extension))
+
+    def partial_filename(self, table):
+        return self.filename(table) + '.partial'
+
+    def write(self, tables):
+        """Write a chunk of rows for every table
+
+        <tables> is a dictionary of table name to list of rows
+        """
+        for table in self.tables:
+            self.write_table(table, table_schema.make_dataframe(table, tables[table]))
+
+    def write_table(self, table, df):
+        raise NotImplementedError()
+
+    def positions(self):
+        raise NotImplementedError()
+
+    def truncate(self, positions):
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+
+class MsgpackWriter(TableWriter):
+    """Appends each chunk to a msgpack file using ``DataFrame.to_msgpack``
+
+    Positions are the sizes of the files in bytes.
+    """
+    extension = 'msg'
+
+    def __init__(self, out_dir, job_id, tables=TABLE_NAMES):
+        super(MsgpackWriter, self).__init__(out_dir, job_id, tables)
+        self._do_append = set()
+
+    def write_table(self, table, df):
+        df.to_msgpack(self.partial_filename(table), append=table in self._do_append)
+        # Append after the first write
+        self._do_append.add(table)
+
+    def positions(self):
+        return {
+            table: os.path.getsize(self.partial_filename(table)) if table in self._do_append else 0
+            for table in self.tables
+        }
+
+    def truncate(self, positions):
+        for table in self.tables:
+            fn = self.partial_filename(table)
+            if positions[table] == 0:
+                self._do_append.discard(table)
+                if isfile(fn):
+                    os.remove(fn)
+            else:
+                with open(fn, 'r+b') as f:
+                    f.truncate(positions[table])
+                self._do_append.add(table)
+
+    def close(self):
+        for table in self.tables:
+            if table not in self._do_append:
+                self.write_table(table, table_schema.make_dataframe(table, []))
+            os.rename(self.partial_filename(table), self.filename(table))
+
+
+class ParquetWriter(TableWriter):
+    """Writes each table to a parquet file with one row group per chunk
+
+    A parquet file can't be read until it has been closed so each chunk is
+    written to a separate file in a directory and these are combined by
+    ``close``. Positions are the number of chunks written.
+    """
+    extension = 'parquet'
+
+    def __init__(self, out_dir, job_id, tables=TABLE_NAMES):
+        super(ParquetWriter, self).__init__(out_dir, job_id, tables)
+        # Only needed when writing parquet files
+        import pyarrow
+        import pyarrow.parquet
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._n_chunks = {table: 0 for table in self.tables}
+        self._schemas = {}
+
+    def _chunk_filename(self, table, i):
+        return join(self.partial_filename(table), '{:05d}.parquet'.format(i))
+
+    def _schema(self, table):
+        if table not in self._schemas:
+            df = table_schema.make_dataframe(table, [])
+            self._schemas[table] = self._pa.Table.from_pandas(df, preserve_index=False).schema
+        return self._schemas[table]
+
+    def write_table(self, table, df):
+        # Don't write empty row groups
+        if len(df) == 0:
+            return
+        if not isdir(self.partial_filename(table)):
+            os.makedirs(self.partial_filename(table))
+        arrow_table = self._pa.Table.from_pandas(df, schema=self._schema(table), preserve_index=False)
+        self._pq.write_table(arrow_table, self._chunk_filename(table, self._n_chunks[table]))
+        self._n_chunks[table] += 1
+
+    def positions(self):
+        return dict(self._n_chunks)
+
+    def truncate(self, positions):
+        for table in self.tables:
+            self._n_chunks[table] = positions[table]
+            if isdir(self.partial_filename(table)):
+                for fn in os.listdir(self.partial_filename(table)):
+                    if int(fn.split('.')[0]) >= positions[table]:
+                        os.remove(join(self.partial_filename(table), fn))
+
+    def close(self):
+        for table in self.tables:
+            # Still create the file if nothing was written so the output of the job is complete
+            writer = self._pq.ParquetWriter(self.filename(table), self._schema(table))
+            for i in range(self._n_chunks[table]):
+                writer.write_table(self._pq.read_table(self._chunk_filename(table, i)).cast(writer.schema))
+            writer.close()
+            if isdir(self.partial_filename(table)):
+                shutil.rmtree(self.partial_filename(table))
+
+
+WRITERS = {
+    'msgpack': MsgpackWriter,
+    'parquet': ParquetWriter,
+}
+
+EXTENSIONS = {name: writer.extension for name, writer in WRITERS.items()}
+
+
+def get_writer(fmt, out_dir, job_id, tables=TABLE_NAMES):
+    if fmt not in WRITERS:
+        raise ValueError('Unknown output format ' + repr(fmt))
+    return WRITERS[fmt](out_dir, job_id, tables)
+
+
+class EventWriter(object):
+    """Buffers the rows of each event and writes them in chunks
+
+    A chunk is written once <flush_events> events or approximately
+    <flush_bytes> bytes (as stored) have been buffered. If <background> is
+    True chunks are passed to a thread which does the writing so the event
+    loop isn't blocked, at most <max_queued> chunks can be waiting.
+
+    After each chunk is written a checkpoint is saved with the number of
+    events which have been written and the positions of the output files. If
+    <resume> is True the output is restored to the state of the last
+    checkpoint and ``n_committed`` events should be skipped, otherwise any
+    previous checkpoint is removed. <event_range> is the ``(first_event,
+    last_event)`` being read, a checkpoint is only resumed for the same range.
+    """
+    def __init__(self, writer, flush_events=10, flush_bytes=None, background=True, max_queued=4, resume=False, event_range=None):
+        self.writer = writer
+        self.event_range = None if event_range is None else list(event_range)
+        self.flush_events = flush_events
+        self.flush_bytes = flush_bytes
+        self.event_index = EventIndex(writer.tables)
+        self.n_committed = 0
+        self.max_queue_depth = 0
+        self._row_nbytes = {table: table_schema.row_nbytes(table) for table in writer.tables}
+        self._clear()
+
+        checkpoint = load_checkpoint(writer.out_dir, writer.job_id) if resume else None
+        if checkpoint is None:
+            # The positions of an old checkpoint would point into the truncated files
+            remove_checkpoint(writer.out_dir, writer.job_id)
+            writer.truncate({table: 0 for table in writer.tables})
+        elif checkpoint['extension'] != writer.extension:
+            raise ValueError('Checkpoint was written for {} files'.format(checkpoint['extension']))
+        elif checkpoint.get('tables', TABLE_NAMES) != writer.tables:
+            raise ValueError('Checkpoint was written for the tables {}'.format(checkpoint.get('tables', TABLE_NAMES)))
+        elif checkpoint.get('event_range') != self.event_range:
+            raise ValueError('Checkpoint was written for the events {}'.format(checkpoint.get('event_range')))
+        else:
+            writer.truncate(checkpoint['positions'])
+            self.event_index = EventIndex.from_dict(checkpoint['index'])
+            self.n_committed = len(self.event_index)
+
+        self._error = None
+        if background:
+            self._queue = Queue(maxsize=max_queued)
+            self._thread = threading.Thread(target=self._run, name='EventWriter')
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._queue = None
+
+    def _clear(self):
+        self._rows = {table: [] for table in self.writer.tables}
+        self._n_events = 0
+        self._n_bytes = 0
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            try:
+                if chunk is None:
+                    return
+                if self._error is None:
+                    self._write(*chunk)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, tables, n_events):
+        self.writer.write(tables)
+        self.n_committed = n_events
+        save_checkpoint(self.writer.out_dir, self.writer.job_id, {
+            'extension': self.writer.extension,
+            'tables': self.writer.tables,
+            'event_range': self.event_range,
+            'positions': self.writer.positions(),
+            'index': self.event_index.to_dict(n_events),
+        })
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError('Failed to write output: ' + repr(self._error))
+
+    @property
+    def queue_depth(self):
+        """Number of chunks waiting to be written"""
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def add_event(self, run_number, event_number, tables):
+        """Add the rows of an event, given as a dictionary of table name to list of rows
+
+        Tables which aren't being written are ignored.
+        """
+        self._check_error()
+        n_rows = {table: len(tables[table]) for table in self.writer.tables}
+        self.event_index.add(run_number, event_number, n_rows)
+        for table in self.writer.tables:
+            self._rows[table].extend(tables[table])
+            self._n_bytes += n_rows[table] * self._row_nbytes[table]
+        self._n_events += 1
+
+        if self._n_events >= self.flush_events or (self.flush_bytes is not None and self._n_bytes >= self.flush_bytes):
+            self.flush()
+
+    def flush(self):
+        if self._n_events == 0:
+            return
+        chunk = (self._rows, len(self.event_index))
+        if self._queue is None:
+            self._write(*chunk)
+        else:
+            self._queue.put(chunk)
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        self._clear()
+
+    def close(self):
+        self.flush()
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+        self._check_error()
+        self.writer.close()
+        save_index(self.event_index, self.writer.out_dir, self.writer.job_id)
+        remove_checkpoint(self.writer.out_dir, self.writer.job_id)
+
+
+def checkpoint_filename(out_dir, job_id):
+    return join(out_dir, 'checkpoint_{}.json'.format(job_id))
+
+
+def save_checkpoint(out_dir, job_id, checkpoint):
+    fn = checkpoint_filename(out_dir, job_id)
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    # Renaming is atomic so the checkpoint is never left half written
+    os.rename(fn + '.tmp', fn)
+
+
+def remove_checkpoint(out_dir, job_id):
+    if isfile(checkpoint_filename(out_dir, job_id)):
+        os.remove(checkpoint_filename(out_dir, job_id))
+
+
+def load_checkpoint(out_dir, job_id):
+    """Return the last checkpoint of a job or None if there isn't one"""
+    fn = checkpoint_filename(out_dir, job_id)
+    if not isfile(fn):
+        return None
+    with open(fn) as f:
+        return json.load(f)
+
+
+def merge_outputs(inputs, writer):
+    """Combine the output of several jobs into the output of ``writer``
+
+    <inputs> is a list of ``(out_dir, job_id)`` in the order the events should
+    be in. Parquet row groups are copied one at a time.
+    """
+    writer.truncate({table: 0 for table in writer.tables})
+    event_index = EventIndex(writer.tables)
+    for out_dir, job_id in inputs:
+        for table in writer.tables:
+            for df in iter_row_groups(find_table(out_dir, table, job_id)):
+                writer.write_table(table, df)
+        event_index.extend(EventIndex.load(index_filename(out_dir, job_id)))
+    writer.close()
+    save_index(event_index, writer.out_dir, writer.job_id)
+
+
+def index_filename(out_dir, job_id):
+    return join(out_dir, 'index_{}.npz'.format(job_id))
+
+
+def save_index(event_index, out_dir, job_id):
+    """Save the index of a job, keeping the tables of the existing index which weren't rewritten"""
+    fn = index_filename(out_dir, job_id)
+    if isfile(fn) and set(event_index.tables) != set(TABLE_NAMES):
+        try:
+            event_index.update(EventIndex.load(fn))
+        except ValueError:
+            # The other tables are from a different set of events
+            pass
+    event_index.save(fn)
+
+
+def find_table(out_dir, table, job_id):
+    """Return the filename of an existing table, preferring parquet"""
+    for fmt in ['parquet', 'msgpack']:
+        fn = join(out_dir, '{}_{}.{}'.format(table, job_id, EXTENSIONS[fmt]))
+        if isfile(fn):
+            return fn
+    return None
+
+
+def read_table(fn, columns=None):
+    """Read a table written by any of the writers, optionally only reading ``columns``"""
+    if fn.endswith('.parquet'):
+        return pd.read_parquet(fn, columns=columns)
+
+    df = pd.read_msgpack(fn)
+    # Appended chunks are returned as a list
+    if isinstance(df, list):
+        df = pd.concat(df)
+    df.columns = [c.decode('utf-8') if isinstance(c, bytes) else c for c in df.columns]
+    if columns is not None:
+        df = df[columns]
+    # Old msgpack files were written without the types from table_schema
+    return table_schema.cast(basename(fn).rsplit('_', 1)[0], df)
+
+
+def read_rows(fn, start, stop, columns=None):
+    """Read rows ``start`` to ``stop`` of a table
+
+    Parquet files only read the row groups which overlap with the range.
+    """
+    return read_ranges(fn, [(start, stop)], columns=columns)[0]
+
+
+def read_ranges(fn, ranges, columns=None):
+    """Read several ``(start, stop)`` row ranges of a table, returning a DataFrame for each
+
+    The file is only read once and parquet files only read the row groups
+    which overlap with the ranges.
+    """
+    if not fn.endswith('.parquet'):
+        df = read_table(fn, columns=columns)
+        return [df.iloc[start:stop] for start, stop in ranges]
+
+    import pyarrow.parquet
+    parquet_file = pyarrow.parquet.ParquetFile(fn)
+    # The first row of each row group which is read and its row in the DataFrame
+    row_groups, first_rows, df_rows = [], [], []
+    offset = 0
+    n_read = 0
+    for i in range(parquet_file.num_row_groups):
+        n_rows = parquet_file.metadata.row_group(i).num_rows
+        if any(offset < stop and offset + n_rows > start for start, stop in ranges):
+            row_groups.append(i)
+            first_rows.append(offset)
+            df_rows.append(n_read)
+            n_read += n_rows
+        offset += n_rows
+
+    if row_groups:
+        df = parquet_file.read_row_groups(row_groups, columns=columns, use_pandas_metadata=True).to_pandas()
+    else:
+        # All of the ranges are empty
+        df = table_schema.make_dataframe(basename(fn).rsplit('_', 1)[0], [])
+        df = df if columns is None else df[columns]
+
+    dfs = []
+    for start, stop in ranges:
+        if stop <= start:
+            dfs.append(df.iloc[0:0])
+            continue
+        # The row groups which overlap with a range are contiguous in the DataFrame
+        i = bisect_right(first_rows, start) - 1
+        df_start = df_rows[i] + start - first_rows[i]
+        dfs.append(df.iloc[df_start:df_start+stop-start])
+    return dfs
+
+
+def iter_table(fn, columns=None, chunk_size=1000000):
+    """Iterate over a table in DataFrames of at most ``chunk_size`` rows
+
+    Parquet files are read a batch at a time, msgpack files have to be read in
+    full and are then split.
+    """
+    if fn.endswith('.parquet'):
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(fn)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns, use_pandas_metadata=True):
+            yield batch.to_pandas()
+    else:
+        df = read_table(fn, columns=columns)
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start:start+chunk_size]
+
+
+def iter_row_groups(fn):
+    """Iterate over the row groups of a parquet file, msgpack files are a single chunk"""
+    if not fn.endswith('.parquet'):
+        yield read_table(fn)
+        return
+
+    import pyarrow.parquet
+    parquet_file = pyarrow.parquet.ParquetFile(fn)
+    for i in range(parquet_file.num_row_groups):
+        yield parquet_file.read_row_group(i, use_pandas_metadata=True).to_pandas()
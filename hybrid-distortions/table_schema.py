@@ -0,0 +1,139 @@
+# [SublimeLinter flake8-max-line-length:150]
+"""Column names and types of the tables produced by read_xdst.py
+
+The writers in table_io cast every chunk to these types before writing, so
+the readers can use the stored types as they are.
+"""
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Bumped whenever the columns or types of a table change
+SCHEMA_VERSION = 5
+
+TABLE_NAMES = ['clusters', 'tracks', 'particles', 'residuals', 'states', 'pvs']
+
+# The track types read_xdst.py can see (see track_tools.state_to_use)
+TRACK_TYPES = ['Velo', 'Long', 'Upstream', 'Downstream', 'Ttrack']
+
+# Types of track whose first state is in the VELO, so they can be extrapolated
+# to the PVs as straight lines
+VELO_TRACK_TYPES = ['Velo', 'Long', 'Upstream']
+
+# The state of each track stored in the states table (see track_tools.state_to_use)
+STATE_LOCATIONS = ['ClosestToBeam', 'FirstMeasurement']
+
+# Parameters of a track state and the (row, column) of the independent
+# elements of its covariance matrix
+STATE_PARAMETERS = ['x', 'y', 'tx', 'ty', 'qop']
+COVARIANCE_ELEMENTS = [(i, j) for i in range(len(STATE_PARAMETERS)) for j in range(i, len(STATE_PARAMETERS))]
+
+# The independent elements of the covariance matrix of a PV's position
+PV_COVARIANCE_ELEMENTS = [(i, j) for i in range(3) for j in range(i, 3)]
+
+# Categories of the categorical columns, the scenario column is added when
+# loading and the categories are the scenarios being loaded
+CATEGORIES = {
+    'track_type': TRACK_TYPES,
+    'state_location': STATE_LOCATIONS,
+}
+
+_event = [('run_number', 'uint32'), ('event_number', 'uint64')]
+
+
+def _xyz(prefix, dtype='float32'):
+    return [(prefix + c, dtype) for c in 'xyz']
+
+
+SCHEMAS = OrderedDict([
+    ('clusters', OrderedDict(_event + [
+        # Fake UT clusters have negative channel IDs
+        ('channel_id', 'int64'),
+    ] + _xyz(''))),
+    ('tracks', OrderedDict(_event + [
+        ('track_number', 'uint16'), ('track_key', 'uint32'), ('track_type', 'category'),
+        ('tx', 'float32'), ('ty', 'float32'),
+    ] + _xyz('p') + _xyz('true_p') + [
+        ('IP3D', 'float32'), ('IPx', 'float32'), ('IPy', 'float32'),
+    ])),
+    # TODO Prompt and charge information
+    ('particles', OrderedDict(_event + [
+        ('kp_track_key', 'uint32'), ('km_track_key', 'uint32'), ('pi_track_key', 'uint32'),
+        ('vertex_chi2', 'float32'), ('vertex_chi2_per_DoF', 'float32'),
+    ] + _xyz('D0_p_') + _xyz('D0_true_p_') + _xyz('vertex_') + _xyz('true_d0_vertex_') + _xyz('pv_') + [
+        ('pv_ipchi2', 'float32'),
+    ] + _xyz('true_dst_vertex_') + [
+        (particle + '_' + column, 'float32')
+        for particle in ['kp', 'km', 'pi']
+        for column in ['px', 'py', 'pz', 'true_px', 'true_py', 'true_pz']
+    ])),
+    ('residuals', OrderedDict(_event + [
+        ('track_number', 'uint16'), ('cluster_channel_id', 'uint32'),
+        ('module', 'uint8'), ('sensor', 'uint8'), ('chip', 'uint8'),
+        ('row', 'uint16'), ('col', 'uint16'), ('scol', 'uint16'),
+    ] + _xyz('intercept_') + _xyz('residual_') + _xyz('true_intercept_') + _xyz('true_residual_'))),
+    ('states', OrderedDict(_event + [
+        ('track_number', 'uint16'), ('track_type', 'category'), ('state_location', 'category'),
+        ('x', 'float32'), ('y', 'float32'), ('z', 'float32'), ('tx', 'float32'), ('ty', 'float32'), ('qop', 'float32'),
+    ] + [
+        ('cov_{}_{}'.format(STATE_PARAMETERS[i], STATE_PARAMETERS[j]), 'float32') for i, j in COVARIANCE_ELEMENTS
+    ])),
+    ('pvs', OrderedDict(_event + [
+        ('pv_number', 'uint16'),
+    ] + _xyz('') + [
+        ('cov_{}_{}'.format('xyz'[i], 'xyz'[j]), 'float32') for i, j in PV_COVARIANCE_ELEMENTS
+    ])),
+])
+
+COLUMNS = {table: list(schema) for table, schema in SCHEMAS.items()}
+
+
+def cast(table, df):
+    """Cast the columns of ``df`` to the types declared for ``table``
+
+    Columns which are missing from ``df`` are ignored so projected reads can
+    also be cast.
+    """
+    for column, dtype in SCHEMAS[table].items():
+        if column not in df:
+            continue
+        if dtype == 'category':
+            values = df[column]
+            if values.dtype == object:
+                # Old files store strings as bytes
+                values = values.map(lambda s: s.decode('utf-8') if isinstance(s, bytes) else s)
+            df[column] = pd.Categorical(values, categories=CATEGORIES[column])
+        elif df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def row_nbytes(table):
+    """Size of a row of ``table`` once it has been cast to the declared types"""
+    return sum(1 if dtype == 'category' else np.dtype(dtype).itemsize for dtype in SCHEMAS[table].values())
+
+
+def make_dataframe(table, rows):
+    """Build the DataFrame for ``table`` from a list of rows"""
+    columns = COLUMNS[table]
+    if not rows:
+        return pd.DataFrame(OrderedDict(
+            (column, pd.Categorical([], categories=CATEGORIES[column]) if dtype == 'category' else np.empty(0, dtype=dtype))
+            for column, dtype in SCHEMAS[table].items()
+        ), columns=columns)
+    df = pd.DataFrame(rows, columns=columns)
+    for column, dtype in SCHEMAS[table].items():
+        # Missing values are stored as NaN
+        if df[column].dtype == object and dtype.startswith('float'):
+            df[column] = pd.to_numeric(df[column])
+    return cast(table, df)
+
+
+def scenario_column(scenario, scenarios, length):
+    """Build the categorical scenario column without repeating the string"""
+    codes = np.full(length, scenarios.index(scenario), dtype=np.int16)
+    return pd.Categorical.from_codes(codes, categories=scenarios)
@@ -1,10 +1,11 @@
 from __future__ import division
 from __future__ import print_function
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from math import atan2, sqrt
 
 import GaudiPython
+import numpy as np
 import ROOT
 from LHCbMath import XYZPoint, XYZVector
 import LoKiAlgo.decorators
@@ -12,6 +13,9 @@ from LoKiPhys.decorators import VIPCHI2
 from LinkerInstances.eventassoc import linkedTo
 GaudiPython.loaddict('libLinkerEvent')
 
+from cluster_store import ClusterStore
+import table_schema
+
 LHCb = GaudiPython.gbl.LHCb
 LineTraj = LHCb.LineTraj
 Range = GaudiPython.gbl.std.pair('double', 'double')
@@ -29,31 +33,13 @@ state_to_use = {
     LHCb.Track.Ttrack: LHCb.State.FirstMeasurement,
     LHCb.Track.Upstream: LHCb.State.FirstMeasurement,
 }
+state_names = {
+    LHCb.State.ClosestToBeam: 'ClosestToBeam',
+    LHCb.State.FirstMeasurement: 'FirstMeasurement',
+}
 
 
-class cached_property(object):
-    """Descriptor (non-data) for building an attribute on-demand on first use.
-
-    Taken from: http://stackoverflow.com/a/4037979/2685230
-    """
-    def __init__(self, factory):
-        """
-        <factory> is called such: factory(instance) to build the attribute.
-        """
-        self._attr_name = factory.__name__
-        self._factory = factory
-
-    def __get__(self, instance, owner):
-        # Build the attribute.
-        attr = self._factory(instance)
-
-        # Cache the value; hide ourselves.
-        setattr(instance, self._attr_name, attr)
-
-        return attr
-
-
-def initialise():
+def initialise(skip_events=0):
     global appMgr, evt, poca, extrap, vertex_fitter, loki_algo
     appMgr = GaudiPython.AppMgr()
     evt = appMgr.evtsvc()
@@ -61,27 +47,78 @@ def initialise():
     extrap = appMgr.toolsvc().create('TrackParabolicExtrapolator', interface='ITrackExtrapolator')
     # vertex_fitter = appMgr.toolsvc().create('OfflineVertexFitter', interface='IVertexFit')
     vertex_fitter = appMgr.toolsvc().create('LoKi::VertexFitter', interface='IVertexFit')
-    run.n = -1
+    # Events skipped by the EventSelector still count towards the event number
+    run.n = skip_events - 1
     loki_algo = LoKiAlgo.decorators.Algo('loki_algo')
     return appMgr, evt
 
 
+def open_input(inputs, skip_events=0):
+    """Read the events of <inputs> with the initialised application
+
+    <inputs> are event selector strings, e.g. from ``IOHelper.dressFile``.
+    The first <skip_events> events are skipped.
+    """
+    selector = appMgr.evtsel()
+    selector.Input = inputs
+    selector.FirstEvent = skip_events + 1
+    selector.reinitialize()
+    run.n = skip_events - 1
+
+
 def run(step=1):
     appMgr.run(1)
     get_clusters.clusters = None
     get_pvs.pvs = None
+    get_pv_positions.positions = None
+    get_dstars.candidates = None
+    get_particles.particles = None
+    get_best_pv.pvs = {}
+    get_mc_particles.particles = None
+    get_mc_particle.particles = {}
     run.n += 1
     return run.n
 
 
 def get_clusters():
+    """Return the ``ClusterStore`` of the current event
+
+    The store is read-only so it is shared rather than copied.
+    """
     # This is very slow so use aggressive caching
     if get_clusters.clusters is None:
-        get_clusters.clusters = {
-            c.channelID().channelID(): Cluster(c)
-            for c in evt['/Event/Raw/VP/Clusters']
-        }
-    return get_clusters.clusters.copy()
+        get_clusters.clusters = ClusterStore.from_clusters(evt['/Event/Raw/VP/Clusters'])
+    return get_clusters.clusters
+
+
+def get_mc_particles():
+    """Return a dictionary of track key to the ``MCParticle`` it is linked to
+
+    Tracks which are not linked to exactly one MC particle map to None.
+    """
+    # The linker is only queried once for each track in an event
+    if get_mc_particles.particles is None:
+        track_to_mc = linkedTo(LHCb.MCParticle, LHCb.Track, 'Rec/Track/Best')
+        particles = {}
+        for track in evt['Rec/Track/Best']:
+            if track_to_mc.range(track).size() == 1:
+                particles[track.key()] = get_mc_particle(track_to_mc.first(track))
+            else:
+                particles[track.key()] = None
+        get_mc_particles.particles = particles
+    return get_mc_particles.particles
+
+
+def get_mc_particle(mc_particle):
+    """Return the ``MCParticle`` for an ``LHCb::MCParticle``
+
+    The same object is returned for each MC particle in an event so the
+    properties (including the mother) are only looked up once.
+    """
+    key = mc_particle.key()
+    if key not in get_mc_particle.particles:
+        get_mc_particle.particles[key] = MCParticle(mc_particle)
+    return get_mc_particle.particles[key]
 
 
 def get_pvs():
@@ -91,26 +128,106 @@ def get_pvs():
     return list(get_pvs.pvs)
 
 
-class Cluster(object):
-    """docstring for Cluster"""
-    def __init__(self, cluster):
-        self._cluster = cluster
+def get_pv_positions():
+    """Return an (n, 3) array of the PV positions in the order of ``get_pvs``"""
+    if get_pv_positions.positions is None:
+        get_pv_positions.positions = np.array([
+            [pv.position().x(), pv.position().y(), pv.position().z()]
+            for pv in get_pvs()
+        ], dtype=np.float64).reshape(-1, 3)
+    return get_pv_positions.positions
+
 
-    @cached_property
-    def channel_id(self):
-        return self._cluster.channelID().channelID()
+# The tracks whose IPs batch_ip can calculate as straight lines
+BATCH_IP_TRACK_TYPES = tuple(table_schema.VELO_TRACK_TYPES)
 
-    @cached_property
-    def x(self):
-        return self._cluster.x()
 
-    @cached_property
-    def y(self):
-        return self._cluster.y()
+def batch_ip(tracks, cross_check=False):
+    """Calculate the IP of every track with respect to its nearest PV
 
-    @cached_property
-    def z(self):
-        return self._cluster.z()
+    Equivalent to ``Track.ip`` for all of the tracks at once, except that the
+    tracks are extrapolated to the PVs as straight lines (the VELO is field
+    free) instead of with the extrapolator. This is only valid for the tracks
+    in ``BATCH_IP_TRACK_TYPES``, the IPs of the other tracks (whose first
+    state is after the magnet) are calculated with ``Track.ip``. Returns an
+    (n, 3) array of IP3D, IPx and IPy. If <cross_check> is True ``Track.ip``
+    is also calculated and the largest absolute difference is kept in
+    ``batch_ip.max_deviation``.
+    """
+    if not tracks:
+        return np.empty((0, 3))
+    pvs = get_pv_positions()
+    assert len(pvs)
+
+    ips = np.empty((len(tracks), 3))
+    batched = np.array([track.track_type in BATCH_IP_TRACK_TYPES for track in tracks])
+    for i in np.flatnonzero(~batched):
+        ips[i] = tracks[i].ip
+    if batched.any():
+        ips[batched] = _line_ips([track for track, b in zip(tracks, batched) if b], pvs)
+
+    if cross_check:
+        deviation = np.abs(ips - np.array([track.ip for track in tracks])).max()
+        batch_ip.max_deviation = max(batch_ip.max_deviation, deviation)
+    return ips
+
+
+batch_ip.max_deviation = 0
+
+
+def _line_ips(tracks, pvs):
+    """IPs of <tracks> extrapolated as straight lines to the nearest of <pvs>"""
+    # Find the PV with the smallest transverse distance at the z of the PV
+    x, y, z, tx, ty = np.array([track.state_parameters for track in tracks]).T[:, :, np.newaxis]
+    dz = pvs[:, 2] - z
+    distance = np.hypot(x + tx*dz - pvs[:, 0], y + ty*dz - pvs[:, 1])
+    best_pv = pvs[np.argmin(distance, axis=1)]
+
+    # Calculate the IP using the first state
+    x, y, z, tx, ty = np.array([track.first_state_parameters for track in tracks]).T
+    dz = best_pv[:, 2] - z
+    IPx = x + tx*dz - best_pv[:, 0]
+    IPy = y + ty*dz - best_pv[:, 1]
+    IP3D = np.sqrt((IPx*IPx + IPy*IPy) / (1 + tx*tx + ty*ty))
+    return np.column_stack([IP3D, IPx, IPy])
+
+
+def line_poca(parameters, points):
+    """Closed form point of closest approach of a straight line to <points>
+
+    <parameters> are the x, y, z, tx and ty of a state on the line and
+    <points> is an (n, 3) array. In the field-free VELO this is equivalent to
+    ``TrajPoca``. Returns (n, 3) arrays of the intercepts and residuals, the
+    residual being the intercept minus the point as with ``TrajPoca``.
+    """
+    x0, y0, z0, tx, ty = parameters
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    t = ((points[:, 0] - x0)*tx + (points[:, 1] - y0)*ty + (points[:, 2] - z0)) / (1 + tx*tx + ty*ty)
+    intercepts = np.column_stack([x0 + t*tx, y0 + t*ty, z0 + t])
+    return intercepts, intercepts - points
+
+
+line_poca.max_deviation = 0
+
+
+def _minimise(traj, position):
+    """Return the point of closest approach of <traj> to <position> and the residual"""
+    residual = XYZVector()
+    s = ROOT.Double(0.1)
+    a = ROOT.Double(0.0005)
+    assert poca.minimize(traj, s, position, residual, a)
+    return traj.position(s), residual
+
+
+class Cluster(object):
+    """A cluster of a ``ClusterStore``"""
+    __slots__ = ('channel_id', 'x', 'y', 'z')
+
+    def __init__(self, channel_id, x, y, z):
+        self.channel_id = channel_id
+        self.x = x
+        self.y = y
+        self.z = z
 
     @property
     def position(self):
@@ -119,6 +236,7 @@ class Cluster(object):
 
 class Hit(object):
     """docstring for Hit"""
+    __slots__ = ('_hit', '_track')
 
     def __init__(self, hit, track):
         self._hit = hit
@@ -130,58 +248,33 @@ class Hit(object):
 
 
 class VPHit(Hit):
-    """docstring for VPHit"""
-    def __init__(self, hit, track):
+    """A VP hit with the fields of its channel ID decoded when it is created"""
+    __slots__ = ('channel_id', 'sidepos', 'module', 'sensor', 'station', 'chip', 'row', 'col', 'scol', 'cluster')
+
+    def __init__(self, hit, track, cluster):
         super(VPHit, self).__init__(hit, track)
         assert self._hit.isVP()
+        vp_id = self._hit.vpID()
+        self.channel_id = vp_id.channelID()
+        self.sidepos = vp_id.sidepos()
+        self.module = vp_id.module()
+        self.sensor = vp_id.sensor()
+        self.station = vp_id.station()
+        self.chip = vp_id.chip()
+        self.row = vp_id.row()
+        self.col = vp_id.col()
+        self.scol = vp_id.scol()
+        self.cluster = cluster
 
-    @cached_property
+    @property
     def vp_id(self):
-        try:
-            return self._vp_id
-        except AttributeError:
-            self._vp_id = self._hit.vpID()
-            return self._vp_id
-
-    @cached_property
-    def cluster(self):
-        return get_clusters()[self.vp_id.channelID()]
-
-    @cached_property
-    def sidepos(self):
-        return self.vp_id.sidepos()
-
-    @cached_property
-    def module(self):
-        return self.vp_id.module()
-
-    @cached_property
-    def sensor(self):
-        return self.vp_id.sensor()
-
-    @cached_property
-    def station(self):
-        return self.vp_id.station()
-
-    @cached_property
-    def chip(self):
-        return self.vp_id.chip()
-
-    @cached_property
-    def row(self):
-        return self.vp_id.row()
-
-    @cached_property
-    def col(self):
-        return self.vp_id.col()
-
-    @cached_property
-    def scol(self):
-        return self.vp_id.scol()
+        return self._hit.vpID()
 
 
 class UTHit(Hit):
     """docstring for UTHit"""
+    __slots__ = ()
+
     def __init__(self, hit, track):
         super(UTHit, self).__init__(hit, track)
         assert self._hit.isUT()
@@ -189,97 +282,167 @@ class UTHit(Hit):
 
 class FTHit(Hit):
     """docstring for FTHit"""
+    __slots__ = ()
+
     def __init__(self, hit, track):
         super(FTHit, self).__init__(hit, track)
         assert self._hit.isFT()
 
 
 class Track(object):
-    """docstring for Track"""
+    """A track with the values needed for every track read when it is created
+
+    The hits, truth matching and IP are only looked up when first used.
+    """
+    __slots__ = (
+        '_track', 'key', 'track_type', 'state_location', 'state_parameters', 'first_state_parameters',
+        'rx', 'ry', 'px', 'py', 'pz', '_hits', '_vp_hits', '_mc_particle', '_ip',
+    )
+
     def __init__(self, track):
         self._track = track
+        self.key = track.key()
+        track_type = track.type()
+        self.track_type = LHCb.Track.TypesToString(track_type)
+        self.state_location = state_names[state_to_use[track_type]]
+
+        state = track.stateAt(state_to_use[track_type])
+        # The x, y, z, tx and ty of the reference state and the first state
+        self.state_parameters = state.x(), state.y(), state.z(), state.tx(), state.ty()
+        first_state = track.firstState()
+        self.first_state_parameters = first_state.x(), first_state.y(), first_state.z(), first_state.tx(), first_state.ty()
+        # The slopes of a state are (tx, ty, 1)
+        self.rx = atan2(state.tx(), 1.)
+        self.ry = atan2(state.ty(), 1.)
+
+        momentum = track.momentum()
+        self.px = momentum.x()
+        self.py = momentum.y()
+        self.pz = momentum.z()
+
+        self._hits = None
+        self._vp_hits = None
+        self._mc_particle = None
+        self._ip = None
 
     def fit_to_point(self, position, minimise=True):
-        state = self.state
-        assert extrap.propagate(state, position.z())
         if minimise:
-            traj = LineTraj(state.position(), state.slopes(), Range(-1000., 1000.))
-            residual = XYZVector()
-            s = ROOT.Double(0.1)
-            a = ROOT.Double(0.0005)
-            assert poca.minimize(traj, s, position, residual, a)
-            return traj.position(s), residual
+            return _minimise(self.trajectory(position.z()), position)
         else:
+            state = self.state
+            assert extrap.propagate(state, position.z())
             return state.position()
 
-    @property
-    def vp_hits(self):
-        return [h for h in self.hits if isinstance(h, VPHit)]
-
-    @cached_property
-    def track_type(self):
-        return LHCb.Track.TypesToString(self._track.type())
-
-    @cached_property
-    def mc_particle(self):
-        track_to_mc = linkedTo(LHCb.MCParticle, LHCb.Track, 'Rec/Track/Best')
-        if track_to_mc.range(self._track).size() == 1:
-            return MCParticle(track_to_mc.first(self._track))
-        else:
-            raise ValueError('More/less that one MC particle found')
-
-    @property
-    def hits(self):
-        for hit in self._track.lhcbIDs():
+    def trajectory(self, z):
+        """Return a ``LineTraj`` tangent to the track at <z>"""
+        state = self.state
+        assert extrap.propagate(state, z)
+        return LineTraj(state.position(), state.slopes(), Range(-1000., 1000.))
+
+    def fit_to_points(self, point_sets, z=None, method='trajpoca'):
+        """Calculate the intercepts and residuals of several sets of points
+
+        <point_sets> is a list of (n, 3) arrays of points, e.g. the distorted
+        and true positions of the track's clusters. The state is propagated
+        once to each distinct value of <z> (by default the z of the first set)
+        and the trajectory is reused for the same row of every set. Returns a list of
+        ``(intercepts, residuals)`` with an (n, 3) array for each set.
+
+        If <method> is ``'line'`` the track is treated as the straight line
+        through the reference state and ``line_poca`` is used instead. With
+        ``'check'`` both are calculated, the results of ``line_poca`` are
+        returned and the largest absolute difference is kept in
+        ``line_poca.max_deviation``.
+        """
+        point_sets = [np.asarray(points, dtype=np.float64).reshape(-1, 3) for points in point_sets]
+        if method in ['line', 'check']:
+            results = [line_poca(self.state_parameters, points) for points in point_sets]
+            if method == 'check':
+                for result, expected in zip(results, self.fit_to_points(point_sets, z)):
+                    for array, expected_array in zip(result, expected):
+                        if len(array):
+                            line_poca.max_deviation = max(line_poca.max_deviation, np.abs(array - expected_array).max())
+            return results
+        elif method != 'trajpoca':
+            raise ValueError('Unknown method: ' + repr(method))
+
+        if z is None:
+            z = point_sets[0][:, 2]
+        results = [(np.empty_like(points), np.empty_like(points)) for points in point_sets]
+        trajectories = {}
+        for i, z_i in enumerate(np.asarray(z, dtype=np.float64).tolist()):
+            if z_i not in trajectories:
+                trajectories[z_i] = self.trajectory(z_i)
+            for points, (intercepts, residuals) in zip(point_sets, results):
+                intercept, residual = _minimise(trajectories[z_i], XYZPoint(*points[i]))
+                intercepts[i] = intercept.x(), intercept.y(), intercept.z()
+                residuals[i] = residual.x(), residual.y(), residual.z()
+        return results
+
+    def _load_hits(self):
+        """Build the hits of the track, the clusters of the VP hits are looked up together"""
+        clusters = get_clusters()
+        lhcb_ids = list(self._track.lhcbIDs())
+        vp_ids = [hit.vpID().channelID() for hit in lhcb_ids if hit.isVP()]
+        rows = clusters.rows(vp_ids)
+        vp_clusters = iter(zip(
+            clusters.channel_ids[rows].tolist(), clusters.x[rows].tolist(), clusters.y[rows].tolist(), clusters.z[rows].tolist()
+        ))
+
+        self._hits = []
+        self._vp_hits = []
+        for hit in lhcb_ids:
             if hit.isVP():
-                yield VPHit(hit, self)
+                vp_hit = VPHit(hit, self, Cluster(*next(vp_clusters)))
+                self._hits.append(vp_hit)
+                self._vp_hits.append(vp_hit)
             elif hit.isUT():
-                yield UTHit(hit, self)
+                self._hits.append(UTHit(hit, self))
             elif hit.isFT():
-                yield FTHit(hit, self)
+                self._hits.append(FTHit(hit, self))
             else:
                 raise ValueError('Unrecognised hit')
 
     @property
-    def state(self):
-        return self._track.stateAt(state_to_use[self._track.type()]).clone()
+    def hits(self):
+        if self._hits is None:
+            self._load_hits()
+        return self._hits
 
-    @cached_property
-    def rx(self):
-        slope = self.state.slopes()
-        return atan2(slope.x(), slope.z())
+    @property
+    def vp_hits(self):
+        if self._vp_hits is None:
+            self._load_hits()
+        return self._vp_hits
+
+    @property
+    def mc_particle(self):
+        if self._mc_particle is None:
+            mc_particle = get_mc_particles().get(self.key)
+            if mc_particle is None:
+                raise ValueError('More/less that one MC particle found')
+            self._mc_particle = mc_particle
+        return self._mc_particle
 
-    @cached_property
-    def ry(self):
-        slope = self.state.slopes()
-        return atan2(slope.y(), slope.z())
+    @property
+    def state(self):
+        return self._track.stateAt(state_to_use[self._track.type()]).clone()
 
-    @cached_property
+    @property
     def p(self):
         return self._track.p()
 
-    @cached_property
+    @property
     def pt(self):
         return self._track.pt()
 
-    @cached_property
-    def px(self):
-        return self._track.momentum().x()
-
-    @cached_property
-    def py(self):
-        return self._track.momentum().y()
-
-    @cached_property
-    def pz(self):
-        return self._track.momentum().z()
-
-    @cached_property
-    def key(self):
-        return self._track.key()
-
-    @cached_property
+    @property
     def ip(self):
+        if self._ip is None:
+            self._ip = self._calculate_ip()
+        return self._ip
+
+    def _calculate_ip(self):
         # Find the PV
         best_distance = 1e1000
         best_pv = None
@@ -308,63 +471,84 @@ class Track(object):
         return IP3D, IPx, IPy
 
 
+# Marks values of MCParticle which haven't been looked up yet
+_NOT_LOADED = object()
+
+
 class MCParticle(object):
-    """docstring for MCParticle"""
+    """An MC particle with its key, PID and momentum read when it is created"""
+    __slots__ = ('_mc_particle', 'key', 'pid', 'px', 'py', 'pz', '_mother', '_origin_vertex')
+
     def __init__(self, mc_particle):
         self._mc_particle = mc_particle
+        self.key = mc_particle.key()
+        self.pid = mc_particle.particleID().pid()
+        momentum = mc_particle.momentum()
+        self.px = momentum.x()
+        self.py = momentum.y()
+        self.pz = momentum.z()
+        self._mother = _NOT_LOADED
+        self._origin_vertex = None
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
             return self._mc_particle == other._mc_particle
         return False
 
-    @cached_property
-    def px(self):
-        return self._mc_particle.momentum().x()
-
-    @cached_property
-    def py(self):
-        return self._mc_particle.momentum().y()
-
-    @cached_property
-    def pz(self):
-        return self._mc_particle.momentum().z()
-
-    @cached_property
-    def pid(self):
-        return self._mc_particle.particleID().pid()
-
-    @cached_property
+    @property
     def mother(self):
-        mother = self._mc_particle.mother()
-        if mother:
-            return MCParticle(mother)
-        else:
+        if self._mother is _NOT_LOADED:
+            mother = self._mc_particle.mother()
+            self._mother = get_mc_particle(mother) if mother else None
+        if self._mother is None:
             raise ValueError('No mother found')
+        return self._mother
 
-    @cached_property
+    @property
     def origin_vertex(self):
-        return self._mc_particle.originVertex().position()
+        if self._origin_vertex is None:
+            self._origin_vertex = self._mc_particle.originVertex().position()
+        return self._origin_vertex
 
-    @cached_property
+    @property
     def end_vertices(self):
         return [v.target().position() for v in self._mc_particle.endVertices()]
 
 
+def get_particles():
+    """Return dictionaries of track key to particle for the pions and kaons"""
+    # Index the containers once per event instead of scanning them for each track
+    if get_particles.particles is None:
+        get_particles.particles = (
+            {p.proto().track().key(): p for p in evt['Phys/PreLoadPions/Particles']},
+            {p.proto().track().key(): p for p in evt['Phys/PreLoadKaons/Particles']},
+        )
+    return get_particles.particles
+
+
+def get_best_pv(particle, track_key):
+    """Return the PV with the smallest IP chi2 for a particle and the chi2"""
+    # VIPCHI2 is evaluated for every PV, so only do it once per track in each event
+    if track_key not in get_best_pv.pvs:
+        best_chi2 = 1e1000
+        best_pv = None
+        func = VIPCHI2(particle, loki_algo.geo())
+        for pv in get_pvs():
+            chi2 = func(pv)
+            if best_chi2 > chi2:
+                best_chi2 = chi2
+                best_pv = pv
+        get_best_pv.pvs[track_key] = best_pv, best_chi2
+    return get_best_pv.pvs[track_key]
+
+
 def fit_vertex(kp_track, km_track, pi_track):
-    pi, kp, km = None, None, None
-    for p in evt['Phys/PreLoadPions/Particles']:
-        if p.proto().track().key() == pi_track.key:
-            pi = p
-
-    for p in evt['Phys/PreLoadKaons/Particles']:
-        p_key = p.proto().track().key()
-        if p_key == kp_track.key:
-            kp = p
-        elif p_key == km_track.key:
-            km = p
-
-    if kp is None or km is None:
+    pions, kaons = get_particles()
+    pi = pions.get(pi_track.key)
+    kp = kaons.get(kp_track.key)
+    km = kaons.get(km_track.key)
+
+    if kp is None or km is None or pi is None:
         raise ValueError('Failed to find tracks')
 
     d0_vertex = LHCb.Vertex()
@@ -377,38 +561,74 @@ def fit_vertex(kp_track, km_track, pi_track):
     true = true_d0_vertex - true_dst_vertex
     fitted = d0_vertex.position() - true_d0_vertex
 
-    best_chi2 = 1e1000
-    best_pv = None
-    func = VIPCHI2(pi, loki_algo.geo())
-    for pv in get_pvs():
-        chi2 = func(pv)
-        if best_chi2 > chi2:
-            best_chi2 = chi2
-            best_pv = pv
+    best_pv, best_chi2 = get_best_pv(pi, pi_track.key)
 
     return D0, best_pv, best_chi2, d0_vertex, true_d0_vertex, true_dst_vertex, true, fitted, kp, km, pi
 
 
-def get_dstars():
-    particles = defaultdict(list)
-    for i, track in enumerate(map(Track, evt['Rec/Track/Best'])):
+def fit_vertices(candidates):
+    """Fit all of the candidates of an event
+
+    Returns a list of ``(candidate, result)`` where result is the output of
+    ``fit_vertex``, candidates whose particles can't be found are skipped.
+    """
+    results = []
+    for candidate in candidates:
         try:
-            if track.mc_particle.mother.pid in [421, -421, 413, -413]:
-                particles[track.mc_particle.pid].append(track)
+            results.append((candidate, fit_vertex(*candidate)))
         except ValueError:
             pass
+    return results
 
-    valid_d0s = []
-    for kp in particles[321]:
-        for km in particles[-321]:
-            if kp.mc_particle.mother == km.mc_particle.mother:
-                valid_d0s.append([kp, km])
 
-    valid_dsts = []
-    for pi in particles[211]+particles[-211]:
-        for kp, km in valid_d0s:
-            if kp.mc_particle.mother.mother == pi.mc_particle.mother:
-                assert km.mc_particle.mother.mother == pi.mc_particle.mother
-                valid_dsts.append([kp, km, pi])
+DstarCandidate = namedtuple('DstarCandidate', ['kp', 'km', 'pi'])
 
-    return valid_dsts
+
+def get_dstars(tracks=None):
+    """Return the truth matched D*+ -> D0(K+ K-) pi+ candidates of the event
+
+    Tracks are indexed by the keys of their MC mother and grandmother in a
+    single pass and the candidates are built by joining on these keys. The
+    candidates are cached until the next event. <tracks> can be given to reuse
+    existing ``Track`` objects (and their truth matching).
+    """
+    if get_dstars.candidates is None:
+        if tracks is None:
+            tracks = map(Track, evt['Rec/Track/Best'])
+
+        kaons_plus = defaultdict(list)
+        kaons_minus = defaultdict(list)
+        pions = []
+        for track in tracks:
+            try:
+                mc_particle = track.mc_particle
+                mother = mc_particle.mother
+            except ValueError:
+                continue
+            if mother.pid not in [421, -421, 413, -413]:
+                continue
+            if mc_particle.pid == 321:
+                kaons_plus[mother.key].append(track)
+            elif mc_particle.pid == -321:
+                kaons_minus[mother.key].append(track)
+            elif mc_particle.pid in [211, -211]:
+                pions.append(track)
+
+        # Pair the kaons with the same mother and index the pairs by their grandmother
+        d0s = defaultdict(list)
+        for mother_key, kps in kaons_plus.items():
+            for kp in kps:
+                try:
+                    grandmother_key = kp.mc_particle.mother.mother.key
+                except ValueError:
+                    continue
+                d0s[grandmother_key].extend((kp, km) for km in kaons_minus.get(mother_key, []))
+
+        # Keep the same order as looping over the pions
+        pions.sort(key=lambda pi: pi.mc_particle.pid != 211)
+        get_dstars.candidates = [
+            DstarCandidate(kp, km, pi)
+            for pi in pions
+            for kp, km in d0s.get(pi.mc_particle.mother.key, [])
+        ]
+    return list(get_dstars.candidates)
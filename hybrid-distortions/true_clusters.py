@@ -0,0 +1,58 @@
+"""Lookup of cluster positions in the original geometry
+
+Used by read_xdst.py to calculate residuals with respect to the true position
+of each cluster when reading a scenario with a distorted geometry.
+"""
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+import table_io
+from cluster_store import ClusterStore
+
+
+class TrueClusterIndex(object):
+    """Cluster positions of every event in a job, built once from the clusters table"""
+    def __init__(self, run_numbers, event_numbers, channel_ids, xyz):
+        order = np.lexsort((channel_ids, event_numbers, run_numbers))
+        run_numbers = run_numbers[order]
+        event_numbers = event_numbers[order]
+        self._channel_ids = channel_ids[order]
+        # Store x, y and z as rows so the slices for each event are contiguous
+        self._xyz = np.ascontiguousarray(xyz[order].T)
+
+        # Find the row range of each event
+        changes = np.flatnonzero(
+            (run_numbers[1:] != run_numbers[:-1]) | (event_numbers[1:] != event_numbers[:-1])
+        ) + 1
+        starts = [0] + changes.tolist()
+        stops = changes.tolist() + [len(order)]
+        self._events = {
+            (int(run_numbers[start]), int(event_numbers[start])): (start, stop)
+            for start, stop in zip(starts, stops)
+            if start < stop
+        }
+
+    @classmethod
+    def from_dataframe(cls, df):
+        return cls(
+            df['run_number'].values, df['event_number'].values, df['channel_id'].values.astype(np.int64),
+            df[['x', 'y', 'z']].values.astype(np.float64)
+        )
+
+    @classmethod
+    def from_file(cls, fn):
+        return cls.from_dataframe(table_io.read_table(fn, columns=['run_number', 'event_number', 'channel_id', 'x', 'y', 'z']))
+
+    def __contains__(self, event):
+        return event in self._events
+
+    def for_event(self, run_number, event_number):
+        """Return the ``ClusterStore`` of an event, the arrays are views so this is cheap"""
+        try:
+            start, stop = self._events[(run_number, event_number)]
+        except KeyError:
+            raise KeyError('Event {} {} not found in the true clusters'.format(run_number, event_number))
+        x, y, z = self._xyz[:, start:stop]
+        return ClusterStore(self._channel_ids[start:stop], x, y, z)